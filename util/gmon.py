@@ -4,7 +4,7 @@ r'''Reactively display all content in the specified directory
 
 # install-me # <- This command will be installed by the install script
 
-from monitor import DirMonitor, FileMonitor
+from monitor import DirMonitor, FileMonitor, StateJournal
 import os, sys, shutil
 import argparse
 from os.path import join, basename, splitext, exists, expanduser, abspath
@@ -81,7 +81,11 @@ class Application(tk.Frame):
         self.master = tk.Tk()
         tk.Frame.__init__(self, self.master)
         self.master.title(f'{this_name} - {self.path}')
-        
+
+        # remember image versions across restarts, so startup doesn't reread every image
+        os.makedirs(expanduser('~/.gmon'), exist_ok=True)
+        ImgFileMonitor.journal = StateJournal.open(expanduser('~/.gmon/monitor.journal'))
+
         self.dm = DirMonitor(path, {
             'jpg': ImgFileMonitor,
             'png': ImgFileMonitor,
@@ -92,6 +96,14 @@ class Application(tk.Frame):
         self.master.geometry("600x200")
         self.master.protocol("WM_DELETE_WINDOW", self.on_close)
 
+    def on_events(self, *_):
+        'dispatch directory events as soon as they are queued'
+        due = self.dm.on_idle()
+        if not self.dm.alive:
+            self.master.quit()
+        elif due is not None:
+            self.after(int(due * 1000) + 1, self.on_events)
+
     def on_close(self):
         self.dm.alive = False
         ifm:ImgFileMonitor
@@ -106,10 +118,9 @@ class Application(tk.Frame):
 def gmon(path: str):
     global app
     app = Application(path)
-    while app.dm.alive:
-        app.dm.on_idle()
-        app.update_idletasks()
-        app.update()
+    app.master.tk.createfilehandler(app.dm.wakeup_fd(), tk.READABLE, app.on_events)
+    app.on_events() # anything queued before the handler was registered
+    app.mainloop()
 
 
 def main():
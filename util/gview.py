@@ -56,6 +56,8 @@ def monkey_qt5():
 
 
 class ImgView(FileMonitor):
+    settle = 0.2 # reload once a burst of writes to the image has been quiet this long
+
     def __init__(self, filename: str):
         global the_imgview
         super().__init__(filename)
@@ -66,7 +68,8 @@ class ImgView(FileMonitor):
         if not exists(gmon_dir):
             os.mkdir(gmon_dir)
 
-        self.yamster = Yamster(join(gmon_dir, f'{basename(filename)}.yaml'))
+        # geom is written on every move/resize event: save at most twice a second
+        self.yamster = Yamster(join(gmon_dir, f'{basename(filename)}.yaml'), write_behind=0.5)
         self.read_img()
 
 
@@ -78,10 +81,13 @@ class ImgView(FileMonitor):
 
         plt.ion()
         plt.show() # blocks until window is closed.
-        
+
+        notifier = backend_qt5.QtCore.QSocketNotifier(self.wakeup_fd(), backend_qt5.QtCore.QSocketNotifier.Read)
+        notifier.activated.connect(self.on_events)
+        self.on_events() # anything queued before the notifier was connected
+
         while self.alive:
-            self.on_idle()
-            self.figure.canvas.start_event_loop(0.05)
+            self.figure.canvas.start_event_loop(0) # until on_events() or on_close() stops it
 
         vprint('run() exiting')
 
@@ -104,6 +110,14 @@ class ImgView(FileMonitor):
             mngr = plt.get_current_fig_manager()
             mngr.window.setGeometry(*geom)
 
+    def on_events(self, *_):
+        'dispatch file events as soon as they are queued'
+        due = self.on_idle()
+        if not self.alive:
+            self.figure.canvas.stop_event_loop()
+        elif due is not None:
+            backend_qt5.QtCore.QTimer.singleShot(int(due * 1000) + 1, self.on_events)
+
     def on_change(self):
         vprint(f'{self.name}.onchange()')
         self.read_img()
@@ -117,6 +131,7 @@ class ImgView(FileMonitor):
         'window closed'
         vprint(f'{self.name}.on_close()')
         self.alive = 0
+        self.figure.canvas.stop_event_loop()
 
     def on_resize(self, _):
         vprint(f'{self.name}.on_resize() -> {self.geom}')
@@ -7,89 +7,730 @@ Written independently by Ken Seehart, not under contract.
 '''
 
 import os, sys
+import unittest
+import tempfile
 import threading
 import time
-from os.path import splitext, isfile, basename
-from queue import Queue
+import ctypes, ctypes.util
+import select
+import struct
+import traceback
+import heapq
+import hashlib
+import asyncio
+import json
+from os.path import splitext, basename, abspath, split, join, relpath, isdir, exists
+from queue import Empty
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # no lock between processes sharing a StateJournal
 
 verbose = False
+use_inotify = True # set False before creating monitors to force the polling loop
 
 def vprint(*args, **kwargs):
     if verbose:
         print(*args, file=sys.stderr, **kwargs)
 
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_MASK_ADD = 0x20000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+FILE_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+DIR_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+
+class Inotify:
+    '''Kernel change notification (linux only)
+    One inotify fd serves every Poller in the process. Each event is translated into a call to the
+    watching poller's poll(), so the change detection logic is shared with the polling loop.
+    '''
+
+    _event = struct.Struct('iIII') # wd, mask, cookie, len
+
+    def __init__(self, watcher: 'Watcher'):
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify requires linux')
+        self.watcher = watcher
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {} # wd -> [(poller, name, mask)]
+        self.paths = {} # wd -> watched path
+
+    def add(self, poller: 'Poller') -> bool:
+        'watch everything the poller asks for, return False if any watch could not be added'
+        for path, name, mask in poller.watches():
+            if not self.watch(poller, path, name, mask):
+                self.remove(poller)
+                return False
+        self.watcher.kick(poller) # prime the poller, as the first iteration of poll_loop would
+        return True
+
+    def watch(self, poller: 'Poller', path: str, name: str, mask: int) -> bool:
+        'add one watch for a poller'
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask | IN_MASK_ADD)
+        if wd < 0:
+            vprint(f'inotify_add_watch({path}): {os.strerror(ctypes.get_errno())}')
+            return False
+        with self.watcher.lock:
+            self.watches.setdefault(wd, []).append((poller, name, mask))
+            self.paths[wd] = path
+        return True
+
+    def remove(self, poller: 'Poller'):
+        with self.watcher.lock:
+            for wd, entries in list(self.watches.items()):
+                entries[:] = [e for e in entries if e[0] is not poller]
+                if not entries:
+                    del self.watches[wd]
+                    self.paths.pop(wd, None)
+                    self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, pending: set) -> list:
+        'add the pollers affected by queued kernel events to pending, return pollers whose watch is gone'
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        lost = []
+        with self.watcher.lock:
+            i = 0
+            while i < len(buf):
+                wd, mask, _, n = self._event.unpack_from(buf, i)
+                name = buf[i+16:i+16+n].rstrip(b'\0').decode(errors='surrogateescape')
+                i += 16 + n
+
+                if mask & IN_Q_OVERFLOW:
+                    for entries in self.watches.values():
+                        for e in entries:
+                            e[0].notify(None)
+                            pending.add(e[0])
+                    continue
+
+                entries = self.watches.get(wd, ())
+                for poller, pname, pmask in entries:
+                    if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF) or (mask & pmask and pname in (None, name)):
+                        poller.notify(self.paths.get(wd), name, mask)
+                        pending.add(poller)
+
+                if mask & IN_IGNORED:
+                    lost.extend(e[0] for e in self.watches.pop(wd, ()))
+                    self.paths.pop(wd, None)
+
+            # a poller is only lost once none of its watches remain
+            watching = {e[0] for entries in self.watches.values() for e in entries} if lost else set()
+        return [p for p in lost if p not in watching]
+
+
+class Watcher:
+    '''The background thread shared by all Pollers
+    Pollers without kernel notification sit in a heap ordered by due time (see Poller.adapt), and every
+    due poller is polled in one batch per wakeup. Between batches the thread blocks in select() on the inotify fd
+    and a wakeup pipe, so the thread count stays at one however many files are watched.
+    '''
+
+    _instance = None
+
+    @classmethod
+    def get(cls) -> 'Watcher':
+        'the process-wide watcher'
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        'stop the process-wide watcher thread; monitors registered with it stop being polled'
+        if cls._instance:
+            cls._instance.running = False
+            cls._instance.wake()
+            cls._instance.thread.join()
+            cls._instance = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = [] # (due time, seq, poller)
+        self.seq = 0
+        self.pending = set() # pollers to poll at the next wakeup
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False) # a full pipe already means a pending wakeup
+        self.running = True
+        try:
+            self.inotify = Inotify(self)
+        except (OSError, AttributeError):
+            self.inotify = None
+        self.thread = threading.Thread(target=self.run, name='monitor.Watcher', daemon=True)
+        self.thread.start()
+
+    def schedule(self, poller: 'Poller', delay: float):
+        'poll the poller after delay seconds'
+        with self.lock:
+            self.seq += 1
+            heapq.heappush(self.heap, (time.monotonic() + delay, self.seq, poller))
+        self.wake()
+
+    def kick(self, poller: 'Poller'):
+        'poll the poller as soon as possible'
+        with self.lock:
+            self.pending.add(poller)
+        self.wake()
+
+    def wake(self):
+        'interrupt the select() of the watcher thread (which checks the heap and pending itself before it)'
+        if threading.current_thread() is self.thread:
+            return
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def remove(self, poller: 'Poller'):
+        'forget the poller (scheduled entries are dropped lazily once it is no longer alive)'
+        if self.inotify:
+            self.inotify.remove(poller)
+
+    def run(self):
+        'watcher thread'
+        fds = [self.wake_r] + ([self.inotify.fd] if self.inotify else [])
+        while self.running:
+            with self.lock:
+                if self.pending: # kicked from this thread, which does not wake itself
+                    timeout = 0
+                else:
+                    timeout = max(0, self.heap[0][0] - time.monotonic()) if self.heap else None
+
+            r, _, _ = select.select(fds, [], [], timeout)
+            if not self.running:
+                break
+            if self.wake_r in r:
+                try:
+                    while os.read(self.wake_r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+
+            lost = []
+            with self.lock:
+                pending, self.pending = self.pending, set()
+            if self.inotify and self.inotify.fd in r:
+                lost = self.inotify.read_events(pending)
+
+            due = []
+            now = time.monotonic()
+            with self.lock:
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+
+            changed = set()
+            for poller in pending | set(due):
+                if poller.alive:
+                    try:
+                        if poller.poll():
+                            changed.add(poller)
+                    except Exception:
+                        traceback.print_exc()
+                else:
+                    self.remove(poller)
+
+            for poller in due:
+                if poller.alive and not poller.inotify: # inotify pollers only schedule one-shot rechecks
+                    self.schedule(poller, poller.adapt(poller in changed))
+
+            for poller in lost:
+                # the watched directory is gone: fall back to polling
+                self.remove(poller)
+                if poller.alive:
+                    poller.start_polling()
+
+
+class EventQueue:
+    '''Queue of command tuples that coalesces bursts
+    A command that is put again while still queued is not queued twice: it moves to the back and its
+    delivery is pushed back, so a burst yields a single delivery once the command has been quiet for
+    settle seconds. At most maxsize distinct commands are held (0 = unbounded); beyond that the oldest
+    is dropped and counted in self.dropped.
+
+    Implements the subset of queue.Queue used by Poller; empty() means nothing is ready for delivery yet.
+    '''
+
+    def __init__(self, settle: float=0.0, maxsize: int=0):
+        self.settle = settle
+        self.maxsize = maxsize
+        self.items = OrderedDict() # command -> due time, in due order
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.listeners = [] # called (from the putting thread) after every put
+
+    def put(self, cmd: tuple):
+        with self.cond:
+            self.items.pop(cmd, None)
+            self.items[cmd] = time.monotonic() + self.settle
+            if self.maxsize and len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.dropped += 1
+            self.cond.notify_all()
+        for fn in list(self.listeners):
+            fn()
+
+    def get(self, block: bool=True, timeout: float=None) -> tuple:
+        'remove and return the oldest command that is due, raise queue.Empty if there is none in time'
+        with self.cond:
+            end = None if timeout is None else time.monotonic() + timeout
+            while True:
+                now = time.monotonic()
+                if self.items:
+                    cmd, due = next(iter(self.items.items()))
+                    if due <= now:
+                        del self.items[cmd]
+                        return cmd
+                    wait = due - now
+                else:
+                    wait = None
+                if not block or (end is not None and now >= end):
+                    raise Empty
+                if end is not None:
+                    wait = end - now if wait is None else min(wait, end - now)
+                self.cond.wait(wait)
+
+    def get_nowait(self) -> tuple:
+        return self.get(False)
+
+    def empty(self) -> bool:
+        with self.cond:
+            return not self.items or next(iter(self.items.values())) > time.monotonic()
+
+    def qsize(self) -> int:
+        'number of pending commands, including those still settling'
+        return len(self.items)
+
+    def next_due(self) -> float:
+        'seconds until the oldest command is due, None if there is none'
+        with self.cond:
+            return max(0, next(iter(self.items.values())) - time.monotonic()) if self.items else None
+
+    async def wait_async(self):
+        'wait in the running event loop until a command is due'
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                pass # loop closed
+
+        self.listeners.append(wake)
+        try:
+            while True:
+                ready.clear()
+                if not self.empty():
+                    return
+                try:
+                    await asyncio.wait_for(ready.wait(), self.next_due())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.listeners.remove(wake)
+
+
 class Poller:
+    '''Base class for monitors
+    Subclasses implement poll(), which is called from the shared Watcher thread and posts commands to self.q.
+    If watches() returns the paths that poll() depends on, and inotify is available, poll() is only
+    called when the kernel reports activity on those paths; otherwise it is polled every `interval` seconds.
+    poll() returns True when it detected a change: the interval then snaps back to min_interval, and
+    otherwise grows by a factor of backoff up to max_interval, so quiet files cost almost nothing.
+    A subclass that overrides poll_loop() (or sets shared = False) gets a private polling thread instead.
+    '''
     thread: threading.Thread
-    q:Queue # queue of command tuples (callable, arg1, arg2, ...)
+    q:EventQueue # queue of command tuples (callable, arg1, arg2, ...)
+
+    min_interval = 0.05 # polling period right after a change (when inotify is not available)
+    max_interval = 2.0 # polling period ceiling for quiet files
+    backoff = 2.0 # interval growth factor per poll without change
+    shared = True # poll from the shared Watcher thread
+    settle = 0.0 # seconds a queued command must be quiet before it is delivered
+    maxsize = 1000 # maximum number of distinct pending commands
 
     def __init__(self):
-        self.q = Queue()
+        self.q = EventQueue(self.settle, self.maxsize)
         self.alive = True
-        self.thread = threading.Thread(target=self.poll_loop)
-        self.thread.start()
-        
+        self.interval = self.min_interval # current polling period
+        self.wake_pipe = None # (r, w) once wakeup_fd() was called
+        self.watcher = Watcher.get()
+        self.thread = self.watcher.thread
+        self.inotify = self.watcher.inotify if use_inotify and self.watches() else None
+
+        if not (self.inotify and self.inotify.add(self)):
+            self.start_polling()
+
+    def watches(self) -> list:
+        'list of (directory, filename or None, inotify mask) that poll() depends on'
+        return []
+
+    def notify(self, path: str, name: str='', mask: int=0):
+        '''called by the watcher thread, before poll(), with the watched path (None: unknown), and the name
+        and mask of each kernel event'''
+        pass
+
+    def start_polling(self):
+        self.inotify = None
+        if self.shared and type(self).poll_loop is Poller.poll_loop:
+            self.thread = self.watcher.thread
+            self.watcher.schedule(self, self.interval)
+        else:
+            self.thread = threading.Thread(target=self.poll_loop)
+            self.thread.start()
+
+    def adapt(self, changed: bool) -> float:
+        'update and return the polling interval after a poll'
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+    def close(self):
+        'stop monitoring'
+        self.alive = False
+        self.watcher.remove(self)
+        self.q.put(None) # wake anyone waiting on the queue
+
     def poll_loop(self):
         'polling thread'
         while self.alive:
-            time.sleep(0.05)
-            self.poll()
+            time.sleep(self.interval)
+            self.adapt(self.poll())
+
+    def on_idle(self, timeout: float=0) -> float:
+        '''call this from the main thread (GUI thread if any, otherwise in run()) to dispatch due commands
+        With a timeout, first block up to timeout seconds (None: indefinitely) until a command is due.
+        Returns the seconds until the next pending command is due (None if there is none), so a GUI loop
+        driven by wakeup_fd() can arm a timer for commands that are still settling.
+        '''
+        if self.wake_pipe:
+            try:
+                os.read(self.wake_pipe[0], 4096)
+            except BlockingIOError:
+                pass
+
+        if timeout != 0:
+            try:
+                self.dispatch(self.q.get(timeout=timeout))
+            except Empty:
+                return self.q.next_due()
 
-    def on_idle(self):
-        'call this from the main thread (GUI thread if any, otherwise in run()) periodically'
         while not self.q.empty():
-            fn = self.q.get_nowait()
-            if fn is not None:
-                fn[0](*fn[1:])
+            self.dispatch(self.q.get_nowait())
+        return self.q.next_due()
+
+    def dispatch(self, fn: tuple):
+        if fn is not None:
+            fn[0](*fn[1:])
+
+    def wakeup_fd(self) -> int:
+        '''file descriptor that becomes readable whenever a command is queued
+        Register it with a GUI loop (tk createfilehandler, Qt QSocketNotifier) and call on_idle() when it fires.
+        '''
+        if not self.wake_pipe:
+            self.wake_pipe = os.pipe()
+            for fd in self.wake_pipe:
+                os.set_blocking(fd, False)
+            self.q.listeners.append(self.wakeup)
+        return self.wake_pipe[0]
+
+    def wakeup(self):
+        try:
+            os.write(self.wake_pipe[1], b'\0')
+        except BlockingIOError:
+            pass # pipe full: the reader has plenty to wake up for
 
     def run_forever(self):
         'Main loop (if you have a GUI thread, use that instead of run_forever() and call self.on_idle() from there)'
         while self.alive:
+            self.on_idle(timeout=1.0)
+
+    async def run_async(self):
+        'asyncio main loop: dispatch commands on the event loop thread as they become due, until the monitor dies'
+        while self.alive:
+            await self.q.wait_async()
             self.on_idle()
-            time.sleep(0.05)
+
+
+def fingerprint(st: os.stat_result) -> tuple:
+    'cheap identity of a file version: changes whenever the file is rewritten, replaced or touched'
+    return (st.st_size, st.st_ino, st.st_mtime_ns)
+
+
+def file_digest(filename: str, chunk_size: int=1<<20) -> str:
+    'digest of the whole file, streamed through a fixed buffer so memory use does not grow with file size'
+    h = hashlib.blake2b(digest_size=16)
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(filename, 'rb', buffering=0) as f:
+        n = f.readinto(buf)
+        while n:
+            h.update(view[:n])
+            n = f.readinto(buf)
+    return h.hexdigest()
+
+
+def sample_digest(filename: str, size: int, blocks: int=64, block_size: int=1<<16) -> str:
+    'digest of the size and evenly spaced blocks (including the first and last) of a large file'
+    if size <= blocks * block_size:
+        return file_digest(filename)
+
+    h = hashlib.blake2b(str(size).encode(), digest_size=16)
+    step = (size - block_size) // (blocks - 1)
+    with open(filename, 'rb') as f:
+        for i in range(blocks):
+            f.seek(i * step)
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+
+class StateJournal:
+    '''On-disk record of the last version of each file seen by FileMonitors
+    One JSON line [path, size, mtime_ns, digest] is appended whenever a monitored file changes, and the
+    last line for a path wins. The journal is compacted when loaded, and whenever it has grown to twice
+    the number of paths it describes.
+    Processes sharing a journal append and compact it under an flock() of <filename>.lock, and reopen it
+    once another process has compacted it.
+    Use StateJournal.open(filename) to share one journal per file within the process.
+    '''
+
+    _instances = {}
+    compact_min = 1000 # never compact journals with fewer lines than this
+
+    @classmethod
+    def open(cls, filename: str) -> 'StateJournal':
+        key = os.path.realpath(filename)
+        if key not in cls._instances:
+            cls._instances[key] = cls(key)
+        return cls._instances[key]
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.lock_fd = None # of <filename>.lock while locked
+        self.lock_depth = 0
+        self.state = {} # path -> (size, mtime_ns, digest)
+        self.f = None
+        self.compact()
+
+    def get(self, path: str) -> tuple:
+        '(size, mtime_ns, digest) last recorded for path, or None'
+        return self.state.get(path)
+
+    def record(self, path: str, size: int, mtime_ns: int, digest: str):
+        rec = (size, mtime_ns, digest)
+        with self.lock:
+            if self.state.get(path) == rec:
+                return
+            self.state[path] = rec
+            with self.locked():
+                try:
+                    replaced = os.stat(self.filename).st_ino != os.fstat(self.f.fileno()).st_ino
+                except FileNotFoundError:
+                    replaced = True
+                if replaced: # compacted by another process
+                    self.f.close()
+                    self.f = open(self.filename, 'a')
+                    self.lines = len(self.state)
+                self.f.write(json.dumps([path, size, mtime_ns, digest]) + '\n')
+                self.f.flush()
+                self.lines += 1
+                if self.lines > max(self.compact_min, 2 * len(self.state)):
+                    self.compact()
+
+    @contextmanager
+    def locked(self):
+        'exclusive lock between processes, reentrant (compact() is called while appending)'
+        if not self.lock_depth and fcntl:
+            self.lock_fd = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        self.lock_depth += 1
+        try:
+            yield
+        finally:
+            self.lock_depth -= 1
+            if not self.lock_depth and self.lock_fd is not None:
+                os.close(self.lock_fd) # releases the lock
+                self.lock_fd = None
+
+    def read(self) -> dict:
+        'the state on disk, including the lines appended by other processes'
+        state = {}
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        path, size, mtime_ns, digest = json.loads(line)
+                    except ValueError:
+                        continue # torn write
+                    state[path] = (size, mtime_ns, digest)
+        except FileNotFoundError:
+            pass
+        return state
+
+    def compact(self):
+        'rewrite the journal with one line per path'
+        with self.locked():
+            # every line of this process is on disk, but the journal may have more
+            self.state = self.read()
+            tmp = f'{self.filename}.{os.getpid()}.tmp'
+            with open(tmp, 'w') as f:
+                for path, rec in self.state.items():
+                    f.write(json.dumps([path, *rec]) + '\n')
+            os.replace(tmp, self.filename)
+            if self.f:
+                self.f.close()
+            self.f = open(self.filename, 'a')
+            self.lines = len(self.state)
 
 
 class FileMonitor(Poller):
     '''Base class for file monitors
     A file monitor watches a specified file, and triggers on_change and on_delete accordingly
+
+    detector selects how a change is recognized once the (size, inode, mtime_ns) fingerprint changes:
+    - 'stat': the fingerprint alone (no reads)
+    - 'digest': blake2 digest of the whole content, so touching a file without changing it is ignored
+    - 'sample': like 'digest', but files larger than 4 MB are only sampled at 64 evenly spaced blocks
+
+    Files of settle_size bytes or more are only digested once their fingerprint has been stable for
+    digest_settle seconds, so a file being streamed is not reread on every write; one that keeps changing
+    (a log being written) is still digested, and reported, every digest_max_delay seconds.
+
+    journal (a StateJournal or its filename) remembers the version of the file across restarts: the file
+    is then only read and reported as changed at startup if it changed while nothing was monitoring it.
     '''
     
     name:str
     filename:str
 
-    def __init__(self, filename:str):
+    detector = 'digest'
+    detectors = ('stat', 'digest', 'sample')
+    journal:StateJournal = None
+    digest_settle = 0.2 # seconds
+    digest_max_delay = 2.0 # seconds
+    settle_size = 1 << 20
+
+    def __init__(self, filename:str, detector:str=None, journal:StateJournal=None):
         self.filename = filename
         self.name = os.path.splitext(basename(filename))[0]
-        self.t = 0
-        self.h = 0
+        if detector:
+            self.detector = detector
+        if self.detector not in self.detectors:
+            raise ValueError(f'unknown detector {self.detector!r}, expected one of {self.detectors}')
+        if journal:
+            self.journal = StateJournal.open(journal) if isinstance(journal, str) else journal
+        self.t = None # fingerprint
+        self.h = None # digest
+        self.settling = None # (fingerprint, since, first change) of a file not digested yet
+        self.recheck_at = None # time of the scheduled recheck of a settling file
+        if self.journal:
+            self.restore()
         super().__init__()
 
+    def restore(self):
+        'start from the version recorded in the journal, so an unchanged file is not reread or reported'
+        rec = self.journal.get(abspath(self.filename))
+        if rec is None:
+            return
+        size, mtime_ns, digest = rec
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            return
+        if (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+            self.t = fingerprint(st)
+            self.h = self.t if self.detector == 'stat' else digest
+        elif self.detector != 'stat':
+            self.h = digest # a touched but unchanged file is still not reported
+
     def __repr__(self):
         return f'<{type(self)}: {self.name}>'
 
+    def watches(self):
+        # watch the parent directory so that files replaced by rename are still tracked
+        d, f = split(abspath(self.filename))
+        return [(d, f, FILE_MASK)]
+
     def poll(self):
         'called by polling thread. Do not make gui calls from here: instead use self.q.put()'
         try:
-            t = os.stat(self.filename)[8]
+            st = os.stat(self.filename)
         except FileNotFoundError:
             self.q.put((self.on_delete,))
             return False
 
+        t = fingerprint(st)
         if self.t != t:
+            if self.detector != 'stat' and st.st_size >= self.settle_size:
+                now = time.monotonic()
+                if self.settling is None:
+                    self.settling = (t, now, now)
+                elif self.settling[0] != t:
+                    self.settling = (t, now, self.settling[2]) # still being written
+                _, since, first = self.settling
+                wait = min(since + self.digest_settle, first + self.digest_max_delay) - now
+                if wait > 0:
+                    self.recheck(now, wait)
+                    return True
+            self.settling = None
             self.t = t
             try:
-                with open(self.filename, 'rb') as f:
-                    h = hash(f.read())
+                h = self.digest(st)
             except FileNotFoundError:
                 self.q.put((self.on_delete,))
                 return False
             except PermissionError:
                 return False
 
+            if self.journal:
+                self.journal.record(abspath(self.filename), st.st_size, st.st_mtime_ns, None if self.detector == 'stat' else h)
+
             if self.h != h:
                 self.h = h
                 self.q.put((self.on_change,))
                 return True
 
+    def recheck(self, now: float, delay: float):
+        'poll again after delay seconds (a polled file already is, at min_interval once poll() returns True)'
+        if self.inotify and (self.recheck_at is None or self.recheck_at <= now):
+            self.recheck_at = now + delay
+            self.watcher.schedule(self, delay)
+
+    def digest(self, st: os.stat_result):
+        'content identity according to self.detector'
+        if self.detector == 'stat':
+            return fingerprint(st)
+        if self.detector == 'sample':
+            return sample_digest(self.filename, st.st_size)
+        return file_digest(self.filename)
+
     def on_change(self):
         vprint('changed '+self.filename)
 
@@ -103,50 +744,455 @@ class DirMonitor(Poller):
     A directory monitor watches a specified directory and attaches a FileMonitor instances (of the specified type)
     to files in that directory.
     
-    fmClass is a FileMonitor class to attach to files with the specified extension
+    ext_types maps a file extension (without the dot) to the FileMonitor class to attach to such files.
+    With ext_types None all files are reported, and no FileMonitor is attached.
+    Views are keyed by path relative to the monitored directory.
+
+    With recursive=True the whole tree is monitored. Each directory is scanned with os.scandir() and its
+    entries are cached; only the directories in which something changed are rescanned (those reported
+    by inotify, or when polling, those whose mtime or cached file stats changed), and the differences are
+    reported precisely through on_add(), on_remove() and on_modify(). Writes reported by inotify only
+    restat the written file.
 
     The process exits if the directory is deleted!
     '''
 
-    def __init__(self, path:str, ext_types:dict):
+    mask = DIR_MASK | IN_MODIFY | IN_CLOSE_WRITE # file writes too, for on_modify
+
+    def __init__(self, path:str, ext_types:dict, recursive:bool=False):
         self.path = path
         self.ext_types = ext_types
+        self.recursive = recursive
         self.views = {}
-        self.t = 0
+        self.dirs = {} # directory -> (mtime_ns, {name: (size, mtime_ns) for files, None for directories})
+        self.lock = threading.Lock()
+        self.touched = set() # directories reported by inotify since the last poll (None: unknown)
+        self.dirty = set() # directories for on_change to rescan
+        self.written = set() # (directory, name) of files reported written by inotify, for on_change to restat
         super().__init__()
 
     def __repr__(self):
         return f'<{type(self)}: {self.path}>'
 
+    def watches(self):
+        return [(d, None, self.mask) for d in list(self.dirs) or [self.path]]
+
+    def notify(self, path: str, name: str='', mask: int=0):
+        with self.lock:
+            if path and name and not mask & ~(IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB):
+                self.written.add((path, name)) # the directory entries did not change
+            else:
+                self.touched.add(path)
+
     def poll(self):
         'called by polling thread. Do not make gui calls from here: instead use self.q.put()'
-        try:
-            t = os.stat(self.path)[8]
-        except FileNotFoundError:
+        if not exists(self.path):
             self.q.put((self.on_delete,))
             return False
 
-        if self.t != t:
-            self.t = t
-            self.q.put((self.on_change,))
+        with self.lock:
+            touched, self.touched = self.touched, set()
+        if not self.dirs:
+            dirty = {self.path} # initial scan
+        elif self.inotify and None not in touched:
+            dirty = touched
+        else:
+            dirty = {d for d, (t, entries) in list(self.dirs.items()) if self.stale(d, t, entries)}
+
+        with self.lock:
+            self.dirty |= dirty
+            if not (self.dirty or self.written):
+                return False
+        self.q.put((self.on_change,))
+        return True
+
+    def stale(self, d: str, t: int, entries: dict) -> bool:
+        'True if a directory, or one of its files, changed since it was scanned'
+        try:
+            if os.stat(d).st_mtime_ns != t:
+                return True
+            for name, v in entries.items():
+                if v is not None:
+                    st = os.stat(join(d, name))
+                    if (st.st_size, st.st_mtime_ns) != v:
+                        return True
+        except FileNotFoundError:
+            return True
+        return False
+
+    def accept(self, name: str) -> bool:
+        'True if files with this name are monitored (all files if ext_types is None)'
+        return self.ext_types is None or splitext(name)[1][1:] in self.ext_types
 
     def on_change(self):
-        fset = set([f for f in os.listdir(self.path) 
-            if splitext(f)[1][1:] in self.ext_types and
-            isfile(os.path.join(self.path, f))])
+        'rescan the directories in which something changed'
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            written, self.written = self.written, set()
+        for d in sorted(dirty): # parents first
+            if d not in self.dirs and d != self.path:
+                continue # dropped by the rescan of its parent
+            try:
+                t = os.stat(d).st_mtime_ns
+            except FileNotFoundError:
+                continue # its parent's rescan will drop it
+            self.scan(d, t)
+        for d, name in sorted(written):
+            if d not in dirty:
+                self.restat(d, name)
+
+    def restat(self, d: str, name: str):
+        'report a written file, without rescanning its directory'
+        entries = self.dirs.get(d, (None, {}))[1]
+        if entries.get(name) is None:
+            return # not monitored, or a directory (a new file comes with a rescan)
+        try:
+            st = os.stat(join(d, name))
+        except FileNotFoundError:
+            return # its removal comes with a rescan
+        v = (st.st_size, st.st_mtime_ns)
+        if v != entries[name]:
+            entries[name] = v
+            self.on_modify(relpath(join(d, name), self.path))
+
+    def scan(self, d: str, t: int):
+        _, old = self.dirs.get(d, (None, {}))
+        entries = {}
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    try:
+                        if e.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                entries[e.name] = None
+                        elif e.is_file() and self.accept(e.name):
+                            st = e.stat()
+                            entries[e.name] = (st.st_size, st.st_mtime_ns)
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            return
+        self.dirs[d] = (t, entries)
+
+        for name, v in old.items():
+            if name not in entries or (v is None) != (entries[name] is None):
+                self.drop(join(d, name), v)
+
+        for name, v in entries.items():
+            p = join(d, name)
+            if name not in old or (v is None) != (old[name] is None):
+                if v is None:
+                    self.add_dir(p)
+                else:
+                    self.on_add(relpath(p, self.path))
+            elif v is not None and v != old[name]:
+                self.on_modify(relpath(p, self.path))
 
-        fkeys = set(self.views.keys())
+    def add_dir(self, d: str):
+        # watch before scanning, so that an entry created in between is reported by a rescan
+        if self.inotify:
+            self.inotify.watch(self, d, None, self.mask)
+        try:
+            self.scan(d, os.stat(d).st_mtime_ns)
+        except FileNotFoundError:
+            return
+
+    def drop(self, p: str, v):
+        'forget a removed file, or a removed directory and everything below it'
+        if v is not None:
+            self.on_remove(relpath(p, self.path))
+            return
+        _, entries = self.dirs.pop(p, (None, {}))
+        for name, v in entries.items():
+            self.drop(join(p, name), v)
 
-        for f in fset-fkeys:
-            self.views[f] = self.ext_types[splitext(f)[1][1:]](os.path.join(self.path, f))
-            print('added '+f)
+    def on_add(self, f: str):
+        if self.ext_types is not None:
+            self.views[f] = self.ext_types[splitext(f)[1][1:]](join(self.path, f))
+        print('added '+f)
 
-        for f in fkeys-fset:
-            self.views.pop(f)
-            print('removed '+f)
+    def on_remove(self, f: str):
+        view = self.views.pop(f, None)
+        if view:
+            view.close()
+        print('removed '+f)
 
+    def on_modify(self, f: str):
+        vprint('modified '+f)
 
     def on_delete(self):
         print('deleted '+self.path)
         self.alive = False
 
+
+Event = namedtuple('Event', 'kind path') # kind: 'change', 'add', 'remove', 'modify' or 'delete'
+
+
+class _FileWatch(FileMonitor):
+    def __init__(self, filename: str, **kwargs):
+        self.events = deque()
+        super().__init__(filename, **kwargs)
+
+    def on_change(self):
+        self.events.append(Event('change', self.filename))
+
+    def on_delete(self):
+        self.events.append(Event('delete', self.filename))
+        self.close()
+
+
+class _DirWatch(DirMonitor):
+    def __init__(self, path: str, **kwargs):
+        self.events = deque()
+        super().__init__(path, None, **kwargs)
+
+    def on_add(self, f):
+        self.events.append(Event('add', join(self.path, f)))
+
+    def on_remove(self, f):
+        self.events.append(Event('remove', join(self.path, f)))
+
+    def on_modify(self, f):
+        self.events.append(Event('modify', join(self.path, f)))
+
+    def on_delete(self):
+        self.events.append(Event('delete', self.path))
+        self.close()
+
+
+async def watch(path: str, recursive: bool=False, **kwargs):
+    '''Asynchronously iterate over the Events of a file or directory, until it is deleted
+
+    async for event in monitor.watch(path, recursive=True):
+        print(event.kind, event.path)
+
+    A directory reports every file in it as added first. Extra keyword arguments go to FileMonitor
+    (e.g. detector) or DirMonitor.
+    '''
+    if isdir(path):
+        m = _DirWatch(path, recursive=recursive, **kwargs)
+    else:
+        m = _FileWatch(path, **kwargs)
+
+    try:
+        while m.alive or m.events:
+            while m.events:
+                yield m.events.popleft()
+            if m.alive:
+                await m.q.wait_async()
+                m.on_idle()
+    finally:
+        m.close()
+
+
+class _Quiet(Poller):
+    'a poller that never sees a change'
+    def poll(self):
+        return False
+
+
+class TestMonitor(unittest.TestCase):
+    def test_adapt(self):
+        p = _Quiet()
+        p.close()
+        self.assertEqual(p.adapt(True), p.min_interval)
+        intervals = [p.adapt(False) for _ in range(10)]
+        self.assertEqual(intervals[:2], [p.min_interval * p.backoff, p.min_interval * p.backoff ** 2])
+        self.assertEqual(intervals, sorted(intervals))
+        self.assertEqual(intervals[-1], p.max_interval) # ceiling
+        self.assertEqual(p.adapt(True), p.min_interval) # snaps back on a change
+
+    def test_wakeup_fd(self):
+        class Settling(_Quiet):
+            settle = 0.2
+        p = Settling()
+        try:
+            fd = p.wakeup_fd()
+            self.assertEqual(select.select([fd], [], [], 0)[0], [])
+            calls = []
+            p.q.put((calls.append, 1))
+            self.assertEqual(select.select([fd], [], [], 1)[0], [fd])
+
+            due = p.on_idle() # still settling: nothing dispatched, a timer to arm
+            self.assertEqual(calls, [])
+            self.assertTrue(0 < due <= 0.2, due)
+            self.assertEqual(select.select([fd], [], [], 0)[0], []) # drained
+
+            self.assertIsNone(p.on_idle(timeout=1))
+            self.assertEqual(calls, [1])
+        finally:
+            p.close()
+
+    def test_event_queue(self):
+        q = EventQueue(settle=0.05, maxsize=2)
+        for _ in range(5):
+            q.put(('a',))
+        q.put(('b',))
+        self.assertEqual(q.qsize(), 2)
+        self.assertTrue(q.empty())
+        self.assertEqual(q.get(timeout=1), ('a',))
+        q.put(('c',))
+        q.put(('d',))
+        self.assertEqual(q.dropped, 1)
+        self.assertEqual(q.get(timeout=1), ('c',))
+        self.assertEqual(q.get(timeout=1), ('d',))
+        with self.assertRaises(Empty):
+            q.get(timeout=0.01)
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'f.txt')
+            with open(filename, 'w') as f:
+                f.write('x')
+            journal = StateJournal(join(dirname, 'journal'))
+            m = FileMonitor(filename, journal=journal, detector='digest')
+            self.assertEqual(m.q.get(timeout=5), (m.on_change,))
+            m.close()
+
+            m = FileMonitor(filename, journal=StateJournal(journal.filename))
+            with self.assertRaises(Empty):
+                m.q.get(timeout=0.2)
+            m.close()
+
+            # two processes sharing the journal: a compaction keeps the lines of the other one,
+            # which then appends to the new file
+            other = StateJournal(journal.filename)
+            other.record('b', 1, 1, None)
+            journal.record('a', 1, 1, None)
+            journal.compact()
+            other.record('c', 1, 1, None)
+            self.assertEqual(set(StateJournal(journal.filename).state), {abspath(filename), 'a', 'b', 'c'})
+
+    def test_watch(self):
+        async def collect(path, n):
+            events = []
+            async for event in watch(path):
+                events.append(event)
+                if len(events) == n:
+                    return events
+
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'f.txt')
+            with open(filename, 'w') as f:
+                f.write('x')
+            events = asyncio.run(asyncio.wait_for(collect(dirname, 1), 5))
+            self.assertEqual(events, [Event('add', filename)])
+
+    def test_digest_settle(self):
+        global use_inotify
+        class Counted(FileMonitor):
+            settle_size = 0
+            def digest(self, st):
+                digests.append(st.st_size)
+                return super().digest(st)
+
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'f.txt')
+            with open(filename, 'w') as f:
+                f.write('x')
+            for inotify in (True, False):
+                use_inotify = inotify
+                try:
+                    digests = []
+                    m = Counted(filename)
+                    self.assertEqual(m.q.get(timeout=5), (m.on_change,))
+                    with open(filename, 'a') as f:
+                        for i in range(20): # streamed faster than digest_settle
+                            f.write('y')
+                            f.flush()
+                            time.sleep(0.01)
+                    self.assertEqual(m.q.get(timeout=5), (m.on_change,))
+                    self.assertEqual(digests, [digests[0], digests[0] + 20], inotify)
+
+                    m.digest_max_delay = 0.3
+                    with open(filename, 'a') as f:
+                        for i in range(20): # never settles, for 1 s
+                            f.write('z')
+                            f.flush()
+                            time.sleep(0.05)
+                        self.assertGreater(m.q.qsize(), 0, inotify) # reported while being written
+                    m.close()
+                finally:
+                    use_inotify = True
+
+    def test_dir_inotify(self):
+        if not Watcher.get().inotify:
+            self.skipTest('no inotify')
+        class Dir(DirMonitor):
+            def scan(self, d, t):
+                scans.append(relpath(d, self.path))
+                super().scan(d, t)
+                if d == sub and not exists(join(sub, 'late')):
+                    open(join(sub, 'late'), 'w').close() # right after the scan of a new directory
+            def on_add(self, f):
+                events.append(('add', f))
+            def on_modify(self, f):
+                events.append(('modify', f))
+
+        def wait_for(done):
+            for _ in range(200):
+                m.on_idle(timeout=0.02)
+                if done():
+                    return True
+            return False
+
+        with tempfile.TemporaryDirectory() as dirname:
+            sub = join(dirname, 'sub')
+            events = []
+            scans = []
+            m = Dir(dirname, None, recursive=True)
+            self.assertTrue(wait_for(lambda: scans))
+            os.mkdir(sub)
+            self.assertTrue(wait_for(lambda: ('add', join('sub', 'late')) in events))
+
+            scans.clear()
+            with open(join(sub, 'late'), 'a') as f:
+                f.write('x')
+            self.assertTrue(wait_for(lambda: ('modify', join('sub', 'late')) in events))
+            self.assertEqual(scans, []) # the written file only
+            m.close()
+
+    def test_dir_untyped(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            m = DirMonitor(dirname, None)
+            m.on_add('f.txt') # no FileMonitor to attach
+            self.assertEqual(m.views, {})
+            m.on_remove('f.txt')
+            m.close()
+
+    def test_dir_modify(self):
+        global use_inotify
+        class Dir(DirMonitor):
+            def on_add(self, f):
+                events.append(('add', f))
+            def on_modify(self, f):
+                events.append(('modify', f))
+
+        def wait_for(event):
+            for _ in range(200):
+                m.on_idle(timeout=0.02)
+                if event in events:
+                    return True
+            return False
+
+        with tempfile.TemporaryDirectory() as dirname:
+            os.mkdir(join(dirname, 'sub'))
+            filename = join(dirname, 'sub', 'f.txt')
+            with open(filename, 'w') as f:
+                f.write('x')
+            for inotify in (True, False):
+                use_inotify = inotify
+                try:
+                    events = []
+                    m = Dir(dirname, None, recursive=True)
+                    self.assertTrue(wait_for(('add', join('sub', 'f.txt'))))
+                    with open(filename, 'a') as f:
+                        f.write('y' * (inotify + 1)) # in place: the directory mtime does not change
+                    self.assertTrue(wait_for(('modify', join('sub', 'f.txt'))), inotify)
+                    m.close()
+                finally:
+                    use_inotify = True
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+r'''Benchmark monitor.FileMonitor and DirMonitor
+
+Runs without a GUI on tmpfs (/dev/shm when available) and prints JSON results, so that polling
+strategies can be compared over time:
+
+- latency: write-to-callback latency percentiles (ms)
+- cpu, rss: CPU seconds per idle second and resident memory, both per 1000 watched files
+- threads: thread count while watching
+- lost, duplicated: callbacks missing or in excess under bursty writers (one callback expected per burst)
+
+Examples:
+  monitor_bench -n 1000 --mode inotify
+  monitor_bench -n 1000 --mode poll -o poll.json
+'''
+
+import os, sys
+import json
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, RawTextHelpFormatter
+from collections import Counter
+from os.path import join, basename, splitext, exists
+
+import monitor
+
+this_name = splitext(basename(__file__))[0]
+
+
+def rss_kb() -> int:
+    'current resident set size in KB'
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 3)
+    return {'p50': pick(.5), 'p90': pick(.9), 'p99': pick(.99), 'max': pick(1)}
+
+
+class BenchFileMonitor(monitor.FileMonitor):
+    written = {} # filename -> monotonic time of the last write
+    latencies = []
+    counts = Counter()
+
+    def on_change(self):
+        t = self.written.get(self.filename)
+        if t is not None:
+            self.latencies.append(time.monotonic() - t)
+            self.counts[self.filename] += 1
+
+
+class BenchDirMonitor(monitor.DirMonitor):
+    def __init__(self, path: str):
+        self.written = {}
+        self.latencies = []
+        super().__init__(path, None, recursive=True)
+
+    def on_add(self, f):
+        t = self.written.pop(f, None)
+        if t is not None:
+            self.latencies.append(time.monotonic() - t)
+
+    def on_remove(self, f):
+        pass
+
+
+def dispatch(monitors: list, seconds: float):
+    'run the monitors\' callbacks in this thread for a while'
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for m in monitors:
+            m.on_idle()
+        time.sleep(0.001)
+
+
+def bench_files(dirname: str, n: int, writes: int, bursts: int, burst_len: int, idle: float) -> dict:
+    files = [join(dirname, f'f{i}.dat') for i in range(n)]
+    for f in files:
+        with open(f, 'w') as fp:
+            fp.write('0')
+
+    rss0 = rss_kb()
+    t0 = time.monotonic()
+    monitors = [BenchFileMonitor(f) for f in files]
+    setup = time.monotonic() - t0
+    dispatch(monitors, 0.5) # initial on_change of every file
+    rss = rss_kb() - rss0
+
+    cpu0 = time.process_time()
+    time.sleep(idle)
+    cpu = (time.process_time() - cpu0) / idle
+
+    # latency: single writes to random files
+    BenchFileMonitor.latencies.clear()
+    m = monitors[0]
+    quiet = (0 if m.inotify else m.max_interval) + m.settle + 0.1 # long enough for any pending callback
+    for i in range(writes):
+        f = random.choice(files)
+        BenchFileMonitor.written[f] = time.monotonic()
+        with open(f, 'w') as fp:
+            fp.write(f'w{i}')
+        dispatch(monitors, 0.02)
+    dispatch(monitors, quiet)
+    latency = percentiles(BenchFileMonitor.latencies)
+
+    # bursts: several quick writes per file, then quiet
+    BenchFileMonitor.counts.clear()
+    targets = [random.choice(files) for _ in range(bursts)]
+    for i, f in enumerate(targets):
+        for j in range(burst_len):
+            BenchFileMonitor.written[f] = time.monotonic()
+            with open(f, 'w') as fp:
+                fp.write(f'b{i}.{j}')
+            time.sleep(0.001)
+        dispatch(monitors, quiet)
+    expected = Counter(targets)
+    got = BenchFileMonitor.counts
+    lost = sum(max(0, expected[f] - got[f]) for f in expected)
+    duplicated = sum(max(0, got[f] - expected[f]) for f in got)
+
+    result = {
+        'files': n,
+        'setup_s': round(setup, 3),
+        'threads': threading.active_count(),
+        'rss_kb_per_1000': round(rss * 1000 / n),
+        'cpu_per_s_per_1000': round(cpu * 1000 / n, 6),
+        'latency_ms': latency,
+        'bursts': bursts,
+        'burst_len': burst_len,
+        'lost': lost,
+        'duplicated': duplicated,
+    }
+    for m in monitors:
+        m.close()
+    return result
+
+
+def bench_dir(dirname: str, n: int, writes: int) -> dict:
+    root = join(dirname, 'tree')
+    for i in range(n):
+        d = join(root, f'd{i % 32}')
+        os.makedirs(d, exist_ok=True)
+        with open(join(d, f'f{i}.dat'), 'w') as fp:
+            fp.write('0')
+
+    t0 = time.monotonic()
+    dm = BenchDirMonitor(root)
+    while len(dm.dirs) < 33 and time.monotonic() - t0 < 60:
+        dispatch([dm], 0.01)
+    scan = time.monotonic() - t0
+
+    for i in range(writes):
+        f = join(f'd{random.randrange(32)}', f'new{i}.dat')
+        dm.written[f] = time.monotonic()
+        with open(join(root, f), 'w') as fp:
+            fp.write('1')
+        dispatch([dm], 0.02)
+    dispatch([dm], (0 if dm.inotify else dm.max_interval) + 0.1)
+
+    result = {
+        'files': n,
+        'initial_scan_s': round(scan, 3),
+        'add_latency_ms': percentiles(dm.latencies),
+        'lost': len(dm.written),
+    }
+    dm.close()
+    return result
+
+
+def monitor_bench(n: int, mode: str, writes: int, bursts: int, burst_len: int, idle: float, tmp: str) -> dict:
+    monitor.use_inotify = mode == 'inotify'
+    dirname = tempfile.mkdtemp(prefix=this_name, dir=tmp)
+    try:
+        return {
+            'mode': mode,
+            'inotify': bool(monitor.Watcher.get().inotify) and monitor.use_inotify,
+            'python': sys.version.split()[0],
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'file_monitor': bench_files(dirname, n, writes, bursts, burst_len, idle),
+            'dir_monitor': bench_dir(dirname, n, writes),
+        }
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+
+def main():
+    parser = ArgumentParser(prog=this_name, formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('-n', type=int, default=1000, help='number of watched files (default 1000)')
+    parser.add_argument('--mode', choices=['inotify', 'poll'], default='inotify', help='change notification strategy')
+    parser.add_argument('--writes', type=int, default=200, help='single writes for the latency test')
+    parser.add_argument('--bursts', type=int, default=20, help='bursts for the lost/duplicated test')
+    parser.add_argument('--burst-len', type=int, default=5, help='writes per burst')
+    parser.add_argument('--idle', type=float, default=2.0, help='seconds of idle CPU measurement')
+    parser.add_argument('--tmp', default='/dev/shm' if exists('/dev/shm') else None, help='scratch directory (default tmpfs)')
+    parser.add_argument('-o', help='write JSON here instead of stdout')
+
+    args = parser.parse_args()
+    result = monitor_bench(args.n, args.mode, args.writes, args.bursts, args.burst_len, args.idle, args.tmp)
+
+    if args.o:
+        with open(args.o, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+if __name__=='__main__':
+    main()
@@ -1,4 +1,4 @@
-'''
+r'''
 String Break
 
 A small collection of monkey-patch hacks that let you do things you aren't supposed to do.
@@ -40,16 +40,41 @@ from write_breakpoint import wbp
 wbp('spam')
 ```
 
+Breakpoints can also be regular expressions:
+
+```
+sbp(r'error \d+', regex=True)
+```
+
 Set a breakpoint in WBPContext.check_string() in this file
 
+# Unattended processes
+
+Instead of breaking, a breakpoint can run an action(breakpoint, string, frame), e.g. to find which code
+writes a log line in a live service:
+
+```
+from stringbreak import sbp, CallsiteCounter, StackRing, Sample, dump_at_exit
+counter = CallsiteCounter()
+sbp('connection reset', action=counter)
+stacks = Sample(StackRing(size=100), n=10)
+sbp(r'timeout after \d+', regex=True, action=stacks)
+dump_at_exit('/tmp/writers.txt', counter, stacks)
+```
+
 When any code writes a specified string to a stream, file, StringIO, or list, the breakpoint will be triggered.
 
 '''
 
+import sys
 import ctypes
 import io
+import re
+import atexit
+import bdb
+import unittest
 from types import MappingProxyType
-from collections import defaultdict
+from collections import defaultdict, deque, Counter
 
 class WBPExecption(Exception):
     pass
@@ -110,7 +135,8 @@ def get_class_dict(cls):
 def magic_flush_mro_cache():
     ctypes.PyDLL(None).PyType_Modified(ctypes.py_object(object))
 
-file_type = type(open(__file__))
+with open(__file__) as f:
+    file_type = type(f)
 
 class ProxyMap:
     def __init__(self):
@@ -130,11 +156,13 @@ class ProxyMap:
 
         def new_fn(*args, fn=fn, sup=super_fn, **kwargs):
             if self.disabled:
-                sup(*args, **kwargs)
+                return sup(*args, **kwargs)
             else:
                 self.disabled = True # prevent recursion
-                fn(sup, *args, **kwargs)
-                self.disabled = False
+                try:
+                    return fn(sup, *args, **kwargs)
+                finally:
+                    self.disabled = False
 
         d[name] = new_fn
         magic_flush_mro_cache()
@@ -150,10 +178,72 @@ class ProxyMap:
             pass
 
 
+class Break:
+    'action: stop in the debugger (go up to the writer)'
+    def __call__(self, bs, s, frame):
+        breakpoint()
+
+
+class StackRing:
+    '''action: keep the stacks of the last size matches, as (code, line number) pairs of up to depth frames
+    Nothing is looked up or formatted until report().'''
+    def __init__(self, size=1000, depth=16):
+        self.ring = deque(maxlen=size)
+        self.depth = depth
+
+    def __call__(self, bs, s, frame):
+        stack = []
+        while frame is not None and len(stack) < self.depth:
+            stack.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        self.ring.append((bs, tuple(stack)))
+
+    def report(self) -> str:
+        lines = []
+        for bs, stack in self.ring:
+            lines.append(f'{bs!r}:')
+            lines += [f'  {code.co_filename}:{line} {code.co_name}' for code, line in stack]
+        return '\n'.join(lines)
+
+
+class CallsiteCounter:
+    'action: count matches by breakpoint and writing line'
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, bs, s, frame):
+        self.counts[bs, frame.f_code, frame.f_lineno] += 1
+
+    def report(self) -> str:
+        return '\n'.join(f'{n:8} {bs!r} {code.co_filename}:{line} {code.co_name}'
+            for (bs, code, line), n in self.counts.most_common())
+
+
+class Sample:
+    'action: pass the first match, and then one in every n, to another action'
+    def __init__(self, action, n=100):
+        self.action = action
+        self.n = n
+        self.count = 0
+
+    def __call__(self, bs, s, frame):
+        if self.count % self.n == 0:
+            self.action(bs, s, frame)
+        self.count += 1
+
+    def report(self) -> str:
+        return f'sampled 1/{self.n} of {self.count} matches\n' + self.action.report()
+
+
 class WBPContext(ProxyMap):
     def __init__(self):
         super().__init__()
-        self.breakpoints = set()
+        self.breakpoints = {} # breakpoint -> regex source
+        self.patterns = {} # breakpoint -> compiled regex
+        self.separate = set() # breakpoints searched on their own, outside the matcher
+        self.matcher = None # the other breakpoints as one alternation
+        self.actions = {} # breakpoint -> action(breakpoint, string, frame)
+        self.errors = 0 # exceptions raised by actions
         self.disabled = False
 
     def enable_hook(self):
@@ -164,36 +254,98 @@ class WBPContext(ProxyMap):
     def disable_hook(self):
         self.clear_proxies()
 
-    def sbp(self, s: str):
-        'set write breakpoint'
+    def compile(self):
+        'rebuild the matcher, so that a write is scanned once whatever the number of breakpoints'
+        combined = [src for s, src in self.breakpoints.items() if s not in self.separate]
+        self.matcher = re.compile('|'.join(f'(?:{src})' for src in combined)) if combined else None
+
+    def sbp(self, s: str, regex: bool=False, action=None):
+        '''set write breakpoint on a string, or on a regular expression
+        action(s, written string, frame of the writer) is called on matches instead of breaking'''
+        src = s if regex else re.escape(s)
+        pattern = re.compile(src) # an invalid pattern raises re.error before anything changes
+        try:
+            # groups would be renumbered (or their names clash) in the alternation, and global flags
+            # are only valid at its start
+            alone = pattern.groups or re.compile(f'(?:{src})').groups
+        except re.error:
+            alone = True
+
         if not self.breakpoints:
             self.enable_hook()
 
-        self.breakpoints.add(s)
+        self.breakpoints[s] = src
+        self.patterns[s] = pattern
+        self.actions[s] = action or Break()
+        if alone:
+            self.separate.add(s)
+        else:
+            self.separate.discard(s)
+        self.compile()
 
     def cbp(self, s=None):
         'clear write breakpoint'
         if s:
-            self.breakpoints.remove(s)
+            del self.breakpoints[s]
+            del self.patterns[s]
+            del self.actions[s]
+            self.separate.discard(s)
         else:
             self.breakpoints.clear()
+            self.patterns.clear()
+            self.actions.clear()
+            self.separate.clear()
+        self.compile()
 
         if not self.breakpoints:
             self.disable_hook()
 
     def proxy_write(self, sup, f, s):
-        sup(f, s)
-        self.check_string(s)
+        n = sup(f, s)
+        if isinstance(s, str):
+            self.check_string(s)
+        return n
 
     def proxy_append(self, sup, l, s):
         sup(l, s)
         if isinstance(s, str):
             self.check_string(s)
 
+    def matches(self, s: str) -> list:
+        '''breakpoints found in s: one search for all the combined ones, and only on a hit a search for each,
+        then a search for each separate one'''
+        hit = self.matcher is not None and self.matcher.search(s)
+        if not hit and not self.separate:
+            return []
+        return [bs for bs, p in self.patterns.items() if (hit or bs in self.separate) and p.search(s)]
+
     def check_string(self, s):
-        for bs in self.breakpoints:
-            if bs in s:
-                breakpoint()
+        found = self.matches(s)
+        if not found:
+            return
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_filename == __file__:
+            frame = frame.f_back # the writer, above the hooks
+
+        for bs in found:
+            try:
+                self.actions[bs](bs, s, frame)
+            except bdb.BdbQuit:
+                raise # quit in the debugger of a Break
+            except Exception:
+                self.errors += 1 # a tracing action must not break the traced process
+
+    def dump_at_exit(self, filename: str, *actions):
+        'write the report() of actions to filename when the process exits'
+        def dump():
+            self.disabled = True # not checking our own writes
+            try:
+                with open(filename, 'w') as f:
+                    for action in actions:
+                        f.write(action.report() + '\n\n')
+            finally:
+                self.disabled = False
+        atexit.register(dump)
 
 
 def add_global_property(k, get_k, set_k):
@@ -247,3 +399,88 @@ wbp_context = WBPContext()
 
 sbp = wbp_context.sbp
 cbp = wbp_context.cbp
+dump_at_exit = wbp_context.dump_at_exit
+
+
+class TestStringBreak(unittest.TestCase):
+    def setUp(self):
+        self.context = WBPContext()
+        self.found = []
+
+    def tearDown(self):
+        self.context.cbp()
+
+    def sbp(self, s, regex=False):
+        self.context.sbp(s, regex, action=lambda bs, s, frame: self.found.append(bs))
+
+    def test_matches(self):
+        self.sbp('a.b')
+        self.sbp(r'err\d+', regex=True)
+        self.sbp(r'(b)\1', regex=True)
+        self.sbp(r'(a)\1', regex=True) # groups: searched separately
+        self.sbp(r'(?P<x>q)', regex=True)
+        self.sbp(r'(?P<x>z)', regex=True) # same group name
+        self.sbp(r'(?i)spam', regex=True) # global flag
+        self.assertEqual(self.context.matches('xaax'), [r'(a)\1'])
+        self.assertEqual(self.context.matches('axb err1 SPAM z'), [r'err\d+', r'(?P<x>z)', r'(?i)spam'])
+        self.assertEqual(self.context.matches('a.b'), ['a.b'])
+        self.assertEqual(self.context.matches('nothing'), [])
+
+        with self.assertRaises(re.error):
+            self.sbp('(', regex=True)
+        self.assertNotIn('(', self.context.breakpoints)
+        self.sbp('ok')
+        self.assertEqual(self.context.matches('ok'), ['ok'])
+
+        self.context.cbp(r'(a)\1')
+        self.assertEqual(self.context.matches('xaax'), [])
+
+    def test_hook(self):
+        self.sbp('spam')
+        lines = []
+        lines.append('spam and eggs')
+        io.StringIO().write('more spam')
+        self.assertEqual(self.found, ['spam', 'spam'])
+
+
+    def test_quit(self):
+        def quit(bs, s, frame):
+            raise bdb.BdbQuit
+        self.context.sbp('spam', action=quit)
+        with self.assertRaises(bdb.BdbQuit):
+            [].append('spam')
+        self.context.sbp('eggs', action=lambda bs, s, frame: 1 / 0)
+        [].append('eggs')
+        self.assertEqual(self.context.errors, 1)
+
+    def test_actions(self):
+        ring = StackRing(size=2, depth=3)
+        counter = CallsiteCounter()
+        sample = Sample(CallsiteCounter(), n=3)
+        self.context.sbp('spam', action=ring)
+        self.context.sbp('eggs', action=counter)
+        self.context.sbp('ham', action=sample)
+        # written from outside this file, which check_string skips to find the writer
+        writer = compile('for s in ["spam"] * 3 + ["eggs"]: lines.append(s)\n'
+            'lines.append("eggs")\n'
+            'for i in range(7): lines.append("ham")\n', '<writer>', 'exec')
+        exec(writer, {'lines': []})
+        self.context.disabled = True # reports, as in dump_at_exit
+
+        self.assertEqual(len(ring.ring), 2)
+        bs, stack = ring.ring[-1]
+        self.assertEqual(bs, 'spam')
+        self.assertLessEqual(len(stack), 3)
+        self.assertEqual(stack[0], (writer, 1))
+        self.assertTrue(ring.report().startswith("'spam':\n  <writer>:1 <module>"))
+
+        self.assertEqual(sorted(counter.counts.values()), [1, 1]) # one per line
+        self.assertEqual(counter.report().count("'eggs' <writer>:"), 2)
+
+        self.assertEqual(sample.count, 7)
+        self.assertEqual(sum(sample.action.counts.values()), 3) # matches 0, 3 and 6
+        self.assertTrue(sample.report().startswith('sampled 1/3 of 7 matches'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,136 +1,1129 @@
 'Yaml store'
 
 import os
-from os.path import exists, join, split
+import io
+import re
+import zlib
+import sqlite3
+import struct
+import pickle
+import hashlib
+from multiprocessing import shared_memory, resource_tracker
+from os.path import exists, join, split, splitext, basename
 from typing import Any, Dict, Callable, NoReturn
 import unittest
 import tempfile
 import time
 import yaml
 import threading
+import weakref
+import gc
+from collections import OrderedDict
+import json
+import atexit
+from contextlib import contextmanager, nullcontext, ExitStack
+from functools import partial
+from urllib.parse import quote
 
 from filelock import Timeout, FileLock # pip3 install filelock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # no shared locks: FileLock for both modes
+
+try:
+    from monitor import Poller, FILE_MASK, DIR_MASK
+except ImportError:
+    from .monitor import Poller, FILE_MASK, DIR_MASK
+
+class Codec:
+    '''Serialization format of a store
+    load(f) and dump(obj, f) read and write a whole document on a text file, dumps(obj) returns it as a
+    string, and errors lists the exceptions raised for values the format cannot represent.
+    '''
+    name = ''
+    errors = ()
+
+    def load(self, f) -> Any:
+        raise NotImplementedError
+
+    def dumps(self, obj: Any) -> str:
+        raise NotImplementedError
+
+    def dump(self, obj: Any, f):
+        f.write(self.dumps(obj)) # serialize fully before touching the file
+
+    def dump_record(self, obj: Any) -> str:
+        'text of one journal record, to be appended to a log of records'
+        raise NotImplementedError
+
+    def load_records(self, f):
+        'iterate over the records of a log, skipping (or stopping quietly at) torn or corrupt records'
+        raise NotImplementedError
+
+    def index(self, text: str) -> Dict[str, tuple]:
+        '''offsets (start, end) of the text of each top-level entry of a document, so that load_entry can
+        parse one entry alone; None if the document cannot be indexed (it is then parsed whole)'''
+        return None
+
+    def load_entry(self, text: str, key: str) -> Any:
+        'parse the text of the single top-level entry key, raising ValueError if it is not that'
+        raise NotImplementedError
+
+
+class YamlCodec(Codec):
+    'YAML, using the libyaml C loader and dumper when available'
+    name = 'yaml'
+    errors = (yaml.representer.RepresenterError,)
+    Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+    def load(self, f) -> Any:
+        return yaml.load(f, Loader=self.Loader)
+
+    def dumps(self, obj: Any) -> str:
+        return yaml.dump(obj, Dumper=self.Dumper)
+
+    def dump_record(self, obj: Any) -> str:
+        return yaml.dump(obj, Dumper=self.Dumper, explicit_start=True)
+
+    def load_records(self, f):
+        try:
+            yield from yaml.load_all(f, Loader=self.Loader)
+        except yaml.YAMLError:
+            return
+
+    line0 = re.compile(r'^(?![ \t\r\n#]|-(?:[ \t\r\n]|$)).+', re.M) # column 0, not a comment or list item
+    plain_key = re.compile(r'([A-Za-z_][\w-]*):(?:[ \t\r]|$)')
+
+    def index(self, text: str) -> Dict[str, tuple]:
+        '''Block mappings with plain keys at column 0, as dumped: every other line is a continuation of
+        the entry above (indented, a comment or a "- " list item). Anything else is not indexed.
+        '''
+        index = {}
+        key = start = None
+        for m in self.line0.finditer(text):
+            k = self.plain_key.match(m.group())
+            if not k:
+                return None # flow mapping, quoted or complex key, document marker, directive...
+            if key is None:
+                if any(line.strip() and not line.lstrip().startswith('#') for line in text[:m.start()].split('\n')):
+                    return None
+            else:
+                index[key] = (start, m.start())
+            key, start = k.group(1), m.start()
+        if key is None:
+            return None
+        index[key] = (start, len(text))
+        return index
+
+    def load_entry(self, text: str, key: str) -> Any:
+        try:
+            entry = yaml.load(text, Loader=self.Loader)
+        except yaml.YAMLError as e: # e.g. an alias to an anchor of another entry
+            raise ValueError(e)
+        if not (isinstance(entry, dict) and list(entry) == [key]):
+            raise ValueError(f'not the entry of {key}') # e.g. "yes:" is a bool key
+        return entry[key]
+
+
+class JsonCodec(Codec):
+    'JSON (stdlib)'
+    name = 'json'
+    errors = (TypeError, ValueError)
+
+    def load(self, f) -> Any:
+        return json.load(f)
+
+    def dumps(self, obj: Any) -> str:
+        return json.dumps(obj, indent=1, sort_keys=True)
+
+    def dump_record(self, obj: Any) -> str:
+        return json.dumps(obj) + '\n'
+
+    def load_records(self, f):
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def get_path(obj: Any, path: tuple) -> Any:
+    'the value at path inside nested dicts and lists, None if absent'
+    for k in path:
+        try:
+            obj = obj[k]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return obj
+
+
+def diff(old: Any, new: Any, path: tuple=()):
+    '''Structural diff: yield (path, old, new) for the innermost values that differ
+    Dicts are compared key by key and lists item by item (missing entries are None); equal subtrees
+    are skipped by a single == test without being walked.
+    '''
+    if old == new:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        for k in list(old) + [k for k in new if k not in old]:
+            yield from diff(old.get(k), new.get(k), path + (k,))
+    elif isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        for i in range(max(len(old), len(new))):
+            yield from diff(old[i] if i < len(old) else None, new[i] if i < len(new) else None, path + (i,))
+    else:
+        yield path, old, new
+
+
+class RWFileLock:
+    '''Shared/exclusive (reader/writer) lock on a lock file, with flock
+    Processes can hold it shared together; within a process the lock is reentrant and threads take
+    turns. A nested exclusive acquire upgrades a shared lock until the outermost release.
+    "with lock:" is exclusive, "with lock.shared():" shared. Without fcntl both are a FileLock.
+
+    acquires, contended and wait count the lock file acquisitions, the ones that had to wait for
+    another process, and the seconds spent waiting.
+    '''
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.mutex = threading.RLock()
+        self.fd = None # open while the lock is held
+        self.mode = 0
+        self.depth = 0
+        self.acquires = 0
+        self.contended = 0
+        self.wait = 0.0
+        self.filelock = None if fcntl else FileLock(filename)
+
+    def acquire(self, exclusive: bool=True):
+        self.mutex.acquire()
+        try:
+            if self.filelock:
+                if not self.depth:
+                    self._lock(self.filelock.acquire, lambda: self.filelock.acquire(timeout=0))
+                self.depth += 1
+                return
+
+            mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            if self.depth and (self.mode == fcntl.LOCK_EX or mode == fcntl.LOCK_SH):
+                self.depth += 1
+                return
+            if not self.depth: # else upgrading: flock converts the lock of the same descriptor
+                self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                self._lock(lambda: fcntl.flock(self.fd, mode), lambda: fcntl.flock(self.fd, mode | fcntl.LOCK_NB))
+            except BaseException:
+                if not self.depth:
+                    os.close(self.fd)
+                    self.fd = None
+                raise
+            self.mode = mode
+            self.depth += 1
+        except BaseException:
+            self.mutex.release()
+            raise
+
+    def _lock(self, lock: Callable, try_lock: Callable):
+        self.acquires += 1
+        try:
+            try_lock()
+        except (BlockingIOError, Timeout):
+            self.contended += 1
+            t = time.monotonic()
+            lock()
+            self.wait += time.monotonic() - t
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth:
+            if self.filelock:
+                self.filelock.release()
+            else:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self.fd = None
+                self.mode = 0
+        self.mutex.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @contextmanager
+    def shared(self):
+        self.acquire(exclusive=False)
+        try:
+            yield self
+        finally:
+            self.release()
+
+
+def _flush_store(ref: weakref.ref):
+    'atexit flush of a write-behind store that is still alive'
+    y = ref()
+    if y is not None:
+        y.flush()
+
 
 class Yamster:
     _filename:str
     _content:Dict[str, Any]
 
-    _cache = {}
+    # live instances by (class, real path); the most recently used ones are also kept alive by _lru
+    _cache = weakref.WeakValueDictionary()
+    _lru = OrderedDict() # key -> instance
+    _cache_lock = threading.RLock()
+    _cache_size = 64 # instances kept alive by the cache
+    _cache_bytes = 64 << 20 # ... as long as their files add up to less than this
+
+    codecs = {'.json': JsonCodec()} # codec by file extension
+    default_codec = YamlCodec()
+
+    _journal_max_records = 1000 # compact the journal into a new snapshot beyond this many records
+    _journal_max_bytes = 1 << 20 # ... or this size
+
+    _shm_size = 1 << 20 # capacity of a shared memory snapshot segment
+    _shm_header = struct.Struct('<QQ') # sequence (odd while being written), payload length
+    _shm_too_big = (1 << 64) - 1 # payload length of a snapshot that does not fit: read the file
 
-    def __new__(cls, filename:str, *args):
-        if filename not in cls._cache:
-            cls._cache[filename] = super().__new__(cls)
+    def __new__(cls, filename:str, *args, **kwargs):
+        if cls is Yamster:
+            if filename.rstrip(os.sep).endswith('.d') or os.path.isdir(filename):
+                cls = ShardedYamster
+            elif splitext(filename)[1].lower() in SqliteYamster._extensions:
+                cls = SqliteYamster
+        key = (cls, os.path.realpath(filename))
+        with cls._cache_lock:
+            self = cls._cache.get(key)
+            if self is None:
+                self = super().__new__(cls)
+                self._size = 0 # file size, as an estimate of memory use
+                cls._cache[key] = self
+            cls._lru[key] = self
+            cls._lru.move_to_end(key)
 
-        return cls._cache[filename]
+            total = sum(y._size for y in cls._lru.values())
+            while len(cls._lru) > 1 and (len(cls._lru) > cls._cache_size or total > cls._cache_bytes):
+                _, evicted = cls._lru.popitem(last=False)
+                total -= evicted._size
+        return self
 
-    def __init__(self, filename:str, callback: Callable[[str, Any, Any], NoReturn]=None):
-        self._filename = filename
+    @classmethod
+    def cache_clear(cls):
+        'forget all cached instances (live ones stay usable, but new constructions reload)'
+        with cls._cache_lock:
+            cls._cache.clear()
+            cls._lru.clear()
 
-        d, f = os.path.split(filename)
+    def __init__(self, filename:str, callback: Callable[[str, Any, Any], NoReturn]=None,
+            write_behind: float=None, fsync: bool=False, codec: Codec=None, journal: bool=False,
+            lazy: bool=False, shm: bool=False):
+        '''
+        codec: serialization format, chosen from Yamster.codecs by file extension by default (YAML otherwise)
+        journal: append key-level change records to .journal.<name> instead of rewriting the whole file.
+            Readers replay the journal over the snapshot, and it is folded into a new snapshot once it
+            exceeds _journal_max_records or _journal_max_bytes. Journals are replayed whatever this setting.
+        write_behind: if not None, writes only update memory and a background flush saves the latest state
+            at most once per write_behind seconds, and on flush(), close() and exit. pending() counts the
+            writes not saved yet.
+        fsync: fsync every save, so that saved data survives a power failure
+        lazy: only read the file; parse it on first access. Reading a key parses that key's entry alone
+            when the codec can index the document (YAML block mappings as dumped), and values are cached
+            until the first write, reload or other access to the whole content parses everything.
+        shm: share the decoded store between processes through a shared memory segment of _shm_size
+            bytes named after the real path. Every save also publishes a pickled snapshot there, and
+            stores that use shm load it instead of parsing the file, and pick up a newer snapshot on the
+            next key read (firing callbacks in the reading thread). All the writers must use shm; the
+            segment outlives the processes until unlink_shm().
+
+        Instances are cached by real path: constructing a store that is already live returns it without
+        rereading the file, only adding the callback. The other options of the first construction stay.
+        '''
+        if '_callbacks' in vars(self): # already initialized (and maybe not loaded yet)
+            if callback:
+                self._callbacks.append(callback)
+                self._react_start()
+            return
+
+        self._filename = os.path.realpath(filename)
+        self._codec = codec or self.codecs.get(splitext(filename)[1].lower(), self.default_codec)
+        self._batch_depth = 0
+        self._undo = None # key -> value before the current batch (None: absent)
+        self._journal = journal
+        self._dirty = set() # keys changed since the last save
+        self._log_records = 0
+        self._mutex = threading.RLock() # guards _content between writers and the write-behind flush
+        self._write_behind = write_behind
+        self._fsync = fsync
+        self._pending = 0
+        self._timer = None
+        self._last_flush = 0
+        self._text = None # unparsed text of a lazy load
+        self._t = None # fingerprint of the file when the content was read
+        self._shm = None
+        self._shm_seq = 0 # sequence of the snapshot in _content
+        self._at_exit = None
+        if write_behind is not None:
+            # flush at exit, without keeping the store alive for the cache to evict
+            self._at_exit = partial(_flush_store, weakref.ref(self))
+            atexit.register(self._at_exit)
+
+        d, f = os.path.split(self._filename)
         self._lock_filename = join(d, '.filelock.'+f)
-        self._lock = FileLock(self._lock_filename)
+        self._lock = RWFileLock(self._lock_filename) # writers only, and readers of a journal
+        self._log_filename = join(d, '.journal.'+f)
+        self._tmp_filename = join(d, '.tmp.'+f)
+        if shm:
+            self._shm_open()
 
         if exists(filename):
-            self._load()
+            if not (lazy and self._load_lazy()):
+                self._load()
         else:
             self._content = {}
             self._save()
 
-        self._callback = callback
+        self._callbacks = [callback] if callback else []
+        self._subscriptions = [] # (path, callback)
 
         if callback:
-            self._react_thread = threading.Thread(target = self._react_monitor)
-            self._react_thread.start()
-            self._t = self._h = 0
+            self._react_start()
+
+    def _react_start(self):
+        if not getattr(self, '_monitor', None):
+            self._monitor = _ReactMonitor(self) # reloads unless the file is still as _load read it
+
+    def subscribe(self, callback: Callable[[tuple, Any, Any], NoReturn], path: tuple=()):
+        '''call callback(path, old, new) for every change made by another writer inside the subtree at path
 
+        store.subscribe(on_geom, ('geom',))   # on_geom(('geom', 2), 10, 20) when geom[2] changes
+        '''
+        if isinstance(path, str):
+            path = (path,)
+        self._subscriptions.append((tuple(path), callback))
+        self._react_start()
 
-    def _react_monitor(self):
-        while 1:
-            time.sleep(0.05)
-            dirty = False
+    def unsubscribe(self, callback: Callable[[tuple, Any, Any], NoReturn]):
+        self._subscriptions = [(p, cb) for p, cb in self._subscriptions if cb != callback]
 
+    def _fingerprint(self) -> tuple:
+        'cheap identity of the stored version: (size, inode, mtime_ns) of the file and its journal'
+        def fp(filename):
             try:
-                t = os.stat(self._filename)[8]
+                st = os.stat(filename)
+                return (st.st_size, st.st_ino, st.st_mtime_ns)
             except FileNotFoundError:
-                dirty = True
-                self._t = t = 0
+                return None
+        return fp(self._filename), fp(self._log_filename)
+
+    def _react(self) -> bool:
+        '''reload and fire callbacks if another writer changed the store
+        Called from the shared monitor thread; the file is only reread when its fingerprint changed.
+        '''
+        t = self._fingerprint()
+        if t == self._t or self._pending:
+            return False # unchanged, or our own write-behind flush is about to replace the file
 
-            if self._t != t:
+        old_content = self._content
+        if t[0]:
+            self._load()
+        else:
+            # deleted: the store is empty until the next write recreates it
+            with self._mutex:
                 self._t = t
+                self._content = self._overlay({})
+            if not exists(split(os.path.abspath(self._filename))[0]):
+                self._monitor.close() # directory gone
 
-                with open(self._filename, 'rb') as f:
-                    h = hash(f.read())
+        return self._notify(old_content, self._content)
 
-                if self._h != h:
-                    self._h = h
-                    dirty = True
+    def _notify(self, old_content: Dict[str, Any], new_content: Dict[str, Any], keys=None) -> bool:
+        'fire the callbacks and subscriptions for the keys (all by default) that differ'
+        if keys is None:
+            keys = list(old_content) + [k for k in new_content if k not in old_content]
+        changed = [k for k in keys if old_content.get(k) != new_content.get(k)]
 
-            if dirty:
-                old_content = self._content.copy()
-                if exists(self._filename):
-                    self._load()
-                else:
-                    self._content = {}
-                    try:
-                        self._save()
-                    except FileNotFoundError:
-                        # directory gone.
-                        break
+        for k in changed:
+            for cb in self._callbacks:
+                cb(k, old_content.get(k, None), new_content.get(k, None))
 
-                for k in set(self._content.keys()) | set(old_content):
-                    if self._content.get(k, None) != old_content.get(k, None):
-                        self._callback(k, old_content.get(k, None), self._content.get(k, None))
+            for path, cb in self._subscriptions:
+                if not path or path[0] == k:
+                    sub = path or (k,)
+                    for p, v0, v1 in diff(get_path(old_content, sub), get_path(new_content, sub), sub):
+                        cb(p, v0, v1)
+        return bool(changed)
 
 
     def __repr__(self):
         return f'<Yamster: {self._filename}'
 
+    def _watches(self) -> list:
+        'inotify watches of the reactive monitor: the file and its journal, through their directory'
+        d, f = split(self._filename)
+        return [(d, f, FILE_MASK), (d, '.journal.'+f, FILE_MASK)]
+
+    def _log_size(self) -> int:
+        try:
+            return os.stat(self._log_filename).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _shm_open(self):
+        name = 'yamster_' + hashlib.blake2b(self._filename.encode(), digest_size=8).hexdigest()
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=self._shm_size)
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name)
+        # the segment must outlive this process, whose resource tracker would unlink it at exit
+        resource_tracker.unregister(self._shm._name, 'shared_memory')
+
+    def unlink_shm(self):
+        'remove the shared memory segment (stores still using it keep it until they exit)'
+        if self._shm is not None:
+            resource_tracker.register(self._shm._name, 'shared_memory') # unlink() unregisters it
+            self._shm.unlink()
+
+    def _publish(self):
+        'write the content to shared memory, with the file fingerprint it matches (seqlock writer, under _lock)'
+        data = pickle.dumps((self._fingerprint(), self._content), pickle.HIGHEST_PROTOCOL)
+        buf = self._shm.buf
+        seq = self._shm_header.unpack_from(buf)[0] | 1
+        struct.pack_into('<Q', buf, 0, seq) # odd: readers retry
+        n = len(data)
+        if self._shm_header.size + n <= len(buf):
+            buf[self._shm_header.size:self._shm_header.size + n] = data
+        else:
+            n = self._shm_too_big
+        self._shm_header.pack_into(buf, 0, seq + 1, n)
+        self._shm_seq = seq + 1
+
+    def _shm_snapshot(self) -> tuple:
+        '''seqlock reader: (sequence, fingerprint, content) of the published snapshot, None if there is none
+        (fingerprint and content are None if it did not fit)'''
+        buf = self._shm.buf
+        for _ in range(1000):
+            seq, n = self._shm_header.unpack_from(buf)
+            if seq == 0:
+                return None
+            if n == self._shm_too_big and not seq & 1:
+                return seq, None, None
+            if seq & 1:
+                time.sleep(0)
+                continue
+            data = bytes(buf[self._shm_header.size:self._shm_header.size + n])
+            if self._shm_header.unpack_from(buf)[0] == seq:
+                return (seq,) + pickle.loads(data)
+        return None
+
+    def _shm_poll(self):
+        'pick up a snapshot published since ours, without touching the file'
+        if self._shm_header.unpack_from(self._shm.buf)[0] == self._shm_seq or self._pending:
+            return
+        snapshot = self._shm_snapshot()
+        if not snapshot:
+            return
+        # like everywhere, _lock (which _load takes) before _mutex
+        with self._lock.shared() if snapshot[2] is None else nullcontext(), self._mutex:
+            if snapshot[0] == self._shm_seq:
+                return
+            old_content = self._content
+            if snapshot[2] is None:
+                self._load() # too big for the segment
+                self._shm_seq = snapshot[0]
+            else:
+                self._shm_seq, _, content = snapshot
+                self._content = self._overlay(content)
+            new_content = self._content
+        self._notify(old_content, new_content) # callbacks may write: not under _mutex
+
     def _load(self):
-        with self._lock:
-            with open(self._filename) as f:
-                self._content = yaml.load(f, Loader=yaml.FullLoader)
-            assert(isinstance(self._content, dict))
+        '''read the snapshot and replay its journal
+        Snapshots are only replaced by atomic renames, so without a journal a lock-free read sees a whole
+        one; a journal is read under the shared lock, so that it is not compacted away meanwhile.
+        '''
+        if self._shm is not None:
+            snapshot = self._shm_snapshot()
+            if snapshot and snapshot[2] is not None and snapshot[1] == self._fingerprint(): # not stale
+                with self._mutex:
+                    self._shm_seq, self._t, self._content = snapshot
+                    self._text = None
+                return
+        with self._lock.shared() if exists(self._log_filename) else nullcontext(), self._mutex:
+            t = self._fingerprint() # before reading: a change during the read is seen by the next _react
+            content, n = self._read()
+            self._t = t
+            self._content = self._overlay(content) # local changes not saved yet survive the reload
+            self._log_records = n
+            self._text = None
+
+    def _read(self) -> tuple:
+        'content of the snapshot with the journal replayed, and the number of journal records'
+        with open(self._filename) as f:
+            content = self._codec.load(f)
+            self._size = os.fstat(f.fileno()).st_size
+        assert(isinstance(content, dict))
+
+        n = 0
+        try:
+            with open(self._log_filename) as f:
+                for rec in self._codec.load_records(f):
+                    if not (isinstance(rec, list) and len(rec) == 3 and rec[2] in (0, 1)):
+                        continue # torn record
+                    k, v, present = rec
+                    if present:
+                        content[k] = v
+                    else:
+                        content.pop(k, None)
+                    n += 1
+        except FileNotFoundError:
+            pass
+        return content, n
+
+    def _load_lazy(self) -> bool:
+        'read the file without parsing it (nor locking it); False if there is a journal to replay (load it then)'
+        if self._log_size():
+            return False
+        self._t = self._fingerprint()
+        with open(self._filename) as f:
+            self._text = f.read()
+        self._size = len(self._text)
+        self._index = None # key -> (start, end) in _text, built on the first key read
+        self._values = {} # key -> value parsed from _text
+        return True
+
+    def _materialize(self):
+        'parse the whole text of a lazy load into _content'
+        with self._mutex:
+            if self._text is None:
+                return
+            content = self._codec.load(io.StringIO(self._text))
+            assert(isinstance(content, dict))
+            content.update((k, v) for k, v in self._values.items() if k in content) # same objects as returned
+            self._content = content
+            self._text = self._index = self._values = None
+
+    def _lazy_get(self, name: str) -> Any:
+        'value of a key before the lazily loaded text is parsed, parsing only its entry when possible'
+        with self._mutex:
+            if self._text is None:
+                return self._content.get(name)
+            if name in self._values:
+                return self._values[name]
+            if self._index is None:
+                self._index = self._codec.index(self._text)
+            if self._index is not None:
+                span = self._index.get(name)
+                if span is None:
+                    return None
+                try:
+                    value = self._values[name] = self._codec.load_entry(self._text[span[0]:span[1]], name)
+                    return value
+                except ValueError:
+                    pass
+            self._materialize()
+            return self._content.get(name)
 
     def _save(self):
-        with self._lock:
-            with open(self._filename, 'w') as f:
-                yaml.safe_dump(self._content, f)
+        with self._lock, self._mutex:
+            current = self._t == self._fingerprint() # no other writer since we read the store
+            compact = True
+            if self._journal and self._dirty and exists(self._filename) and self._log_intact():
+                self._append_log()
+                compact = self._log_records >= self._journal_max_records or self._log_size() >= self._journal_max_bytes
+            if compact and exists(self._log_filename):
+                # fold the journal as it is on disk, with the records of other writers
+                content = self._fold()
+                self._write_snapshot(content)
+                old_content, self._content = self._content, content
+                self._notify(old_content, content)
+            elif compact:
+                self._write_snapshot(self._content)
+            if compact or current:
+                self._t = self._fingerprint() # our own write: no reload by _react
+            if self._shm is not None:
+                self._publish()
+
+    def _log_intact(self) -> bool:
+        'False if the journal ends with a torn record (a writer died mid-append): it must then be compacted'
+        try:
+            with open(self._log_filename, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    return True
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) == b'\n'
+        except FileNotFoundError:
+            return True
+
+    def _append_log(self):
+        'append a record for each dirty key: [key, value, 1], or [key, None, 0] for a deletion'
+        text = ''.join(self._codec.dump_record([k, self._content[k], 1] if k in self._content else [k, None, 0])
+            for k in self._dirty)
+        with open(self._log_filename, 'a') as f:
+            f.write(text)
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._log_records += len(self._dirty)
+        self._dirty.clear()
+
+    def _fold(self) -> Dict[str, Any]:
+        'the snapshot with the journal replayed, and the keys not appended yet on top (under _lock)'
+        content, _ = self._read()
+        return self._overlay(content)
+
+    def _overlay(self, content: Dict[str, Any]) -> Dict[str, Any]:
+        'content with the keys changed here and not saved yet (in a batch, or waiting for the lock) on top'
+        for k in self._dirty:
+            if k in self._content:
+                content[k] = self._content[k]
+            else:
+                content.pop(k, None)
+        return content
+
+    def _write_snapshot(self, content: Dict[str, Any]):
+        'replace the file atomically (temp file, fsync, rename), then drop the journal it supersedes'
+        text = self._codec.dumps(content)
+        self._size = len(text)
+        with open(self._tmp_filename, 'w') as f:
+            f.write(text)
+            f.flush()
+            if self._fsync or self._journal:
+                os.fsync(f.fileno())
+        os.replace(self._tmp_filename, self._filename)
+        if self._log_records or exists(self._log_filename):
+            os.remove(self._log_filename)
+        self._log_records = 0
+        self._dirty.clear()
+
+    def _commit(self):
+        'persist the in-memory content now, or later in write-behind mode'
+        if self._write_behind is None:
+            self._save()
+            return
+
+        with self._mutex:
+            self._pending += 1
+            if self._timer is None:
+                delay = max(0, self._last_flush + self._write_behind - time.monotonic())
+                self._timer = threading.Timer(delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        'save pending write-behind changes now'
+        with self._mutex:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self._pending:
+                return
+        with self._lock, self._mutex: # _save's lock order: _lock before _mutex
+            if self._pending:
+                self._save()
+                self._pending = 0
+                self._last_flush = time.monotonic()
+
+    def pending(self) -> int:
+        'number of write-behind writes not saved yet'
+        return self._pending
+
+    def close(self):
+        'flush pending writes and stop reacting to changes'
+        self.flush()
+        if self._at_exit:
+            atexit.unregister(self._at_exit)
+            self._at_exit = None
+        if getattr(self, '_monitor', None):
+            self._monitor.close()
+            self._monitor = None
 
     def __getattr__(self, name: str) -> Any:
+        if name == '_content' and vars(self).get('_text') is not None:
+            self._materialize()
+            return self._content
         if name.startswith('_'):
             return super().__getattr__(name)
         else:
+            if self._shm is not None:
+                self._shm_poll()
+            if vars(self).get('_text') is not None:
+                return self._lazy_get(name)
             try:
                 return self._content[name]
             except KeyError:
                 return None
 
     def __setattr__(self, name: str, value: Any) -> None:
+        if name.startswith('_'):
+            return super().__setattr__(name, value)
+        if hasattr(type(self), name):
+            raise AttributeError(f'{name} is a {type(self).__name__} attribute: use store[{name!r}] for that key')
+        self.__setitem__(name, value)
+
+    def __setitem__(self, name: str, value: Any) -> None:
         if name.startswith('_'):
             return super().__setattr__(name, value)
         else:
             if self._content.get(name, None) != value:
-                with self._lock:
-                    backup = self._content.copy()
+                if self._write_behind is not None:
+                    # the flush happens later, so check that this value can be saved now
+                    try:
+                        self._codec.dumps(value)
+                    except self._codec.errors:
+                        raise TypeError(f"type({name}): {type(value)} is not serializable as {self._codec.name}")
 
-                    if value is None:
-                        if name in self._content:
-                            del self._content[name]
-                    else:
-                        self._content[name] = value
+                if self._batch_depth:
+                    self._set(name, value)
+                    return
+
+                if self._write_behind is not None:
+                    self._set(name, value)
+                    self._commit()
+                    return
+
+                with self._mutex:
+                    undo = {name: self._content.get(name)}
+                    self._set(name, value)
 
                 try:
-                    self._save()
-                except yaml.representer.RepresenterError:
-                    self._content = backup
-                    raise TypeError(f"type({name}): {type(value)} is not serializable as yaml")
+                    self._save() # the only lock acquisition of a write
+                except self._codec.errors:
+                    self._rollback(undo)
+                    raise TypeError(f"type({name}): {type(value)} is not serializable as {self._codec.name}")
+
+    def _set(self, name: str, value: Any):
+        'in-memory mutation'
+        with self._mutex:
+            if self._undo is not None and name not in self._undo:
+                self._undo[name] = self._content.get(name)
+            if value is None:
+                if name in self._content:
+                    del self._content[name]
+            else:
+                self._content[name] = value
+            self._dirty.add(name)
+
+    def _rollback(self, undo: Dict[str, Any]):
+        'restore the values saved in an undo dict (only the keys that changed, no document copy)'
+        with self._mutex:
+            for name, value in undo.items():
+                if value is None:
+                    self._content.pop(name, None)
+                else:
+                    self._content[name] = value
+
+    @contextmanager
+    def batch(self):
+        '''Apply many mutations in memory, and save them with a single lock and dump at the end
+
+        with store.batch():
+            store.x = 1
+            store.y = 2
+
+        Batches nest; only the outermost one saves. If the block raises, or the result is not
+        serializable, every mutation of the batch is rolled back.
+        '''
+        if not self._batch_depth:
+            self._undo = {}
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self._batch_depth == 1:
+                self._rollback(self._undo)
+            raise
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                undo, self._undo = self._undo, None
+
+        if not self._batch_depth and any(self._content.get(k) != v for k, v in undo.items()):
+            try:
+                self._commit()
+            except self._codec.errors as e:
+                self._rollback(undo)
+                raise TypeError(f"batch is not serializable as {self._codec.name}: {e}")
+
+    def update(self, values: Dict[str, Any]):
+        'set several keys at once (None deletes), with a single save'
+        with self.batch():
+            for k, v in values.items():
+                self[k] = v
 
     def __delattr__(self, name: str) -> None:
         self.__setattr__(name, None)
 
+    def __delitem__(self, name: str) -> None:
+        self.__setitem__(name, None)
+
     __getitem__ = __getattr__
-    __setitem__ = __setattr__
-    __delitem__ = __delattr__
+
+
+class ShardedYamster(Yamster):
+    '''Yamster stored in a directory, with one file per top-level key or per hash bucket of keys
+    Yamster() returns one for existing directories and paths ending with .d. A save only locks and
+    rewrites the shards of the keys it changed, merged with what the other keys of those shards hold on
+    disk, so writers of different keys do not contend on one lock; a reactive store rereads only the
+    shards that changed.
+    '''
+    def __init__(self, dirname: str, callback: Callable[[str, Any, Any], NoReturn]=None,
+            write_behind: float=None, fsync: bool=False, codec: Codec=None, journal: bool=False,
+            lazy: bool=False, buckets: int=None):
+        '''
+        buckets: number of hash buckets of keys, each stored in one file, or None for a file per key.
+            All the writers of a store must agree on it.
+        The other arguments are those of Yamster, except that journal and lazy do not apply to shards.
+        '''
+        if '_callbacks' not in vars(self):
+            self._buckets = buckets
+            self._shard_t = {} # shard file -> fingerprint when last read
+            self._shard_keys = {} # shard file -> keys it held
+        super().__init__(dirname, callback, write_behind, fsync, codec)
+        self._lock = self._mutex # no store-wide file lock: shards have their own
+
+    def _shard(self, key: str) -> str:
+        'file name of the shard of a key'
+        if self._buckets:
+            name = f'{zlib.crc32(key.encode()) % self._buckets:04x}'
+        else:
+            name = quote(key, safe='')
+            if name.startswith('.'):
+                name = '%2E' + name[1:] # dot files are locks and temp files
+        return f'{name}.{self._codec.name}'
+
+    def _shards(self) -> Dict[str, tuple]:
+        'fingerprint (size, inode, mtime_ns) of each shard file'
+        t = {}
+        try:
+            with os.scandir(self._filename) as it:
+                for e in it:
+                    if not e.name.startswith('.') and e.is_file():
+                        st = e.stat()
+                        t[e.name] = (st.st_size, st.st_ino, st.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return t
+
+    def _read_shard(self, name: str) -> Dict[str, Any]:
+        try:
+            with open(join(self._filename, name)) as f:
+                content = self._codec.load(f)
+        except FileNotFoundError:
+            return {}
+        assert(isinstance(content, dict))
+        return content
+
+    def _fingerprint(self):
+        return None # per shard, in _shard_t
+
+    def _watches(self) -> list:
+        return [(self._filename, None, FILE_MASK | DIR_MASK)]
+
+    def _load(self):
+        with self._mutex:
+            self._content = {}
+            self._shard_t = {}
+            self._shard_keys = {}
+            self._refresh()
+
+    def _refresh(self) -> set:
+        'reread the shards that changed since they were last read, return the keys they held or hold'
+        t = self._shards()
+        keys = set()
+        with self._mutex:
+            content = None
+            for name in set(self._shard_t) | set(t):
+                if self._shard_t.get(name) == t.get(name):
+                    continue
+                if content is None:
+                    content = dict(self._content) # readers keep a consistent snapshot
+                shard = self._read_shard(name) if name in t else {}
+                for k in self._shard_keys.pop(name, ()):
+                    if k not in shard:
+                        content.pop(k, None)
+                        keys.add(k)
+                content.update(shard)
+                keys.update(shard)
+                if shard:
+                    self._shard_keys[name] = list(shard)
+                if name in t:
+                    self._shard_t[name] = t[name]
+                else:
+                    del self._shard_t[name]
+            if content is not None:
+                self._content = content
+                self._size = sum(st[0] for st in t.values())
+        return keys
+
+    def _react(self) -> bool:
+        if self._pending:
+            return False # our own write-behind flush is about to replace the shards
+        with self._mutex:
+            old_content = self._content
+            keys = self._refresh()
+        if not exists(self._filename):
+            self._monitor.close() # directory gone
+        return self._notify(old_content, self._content, keys)
+
+    def _save(self):
+        '''lock the shards of the dirty keys (in name order, so that writers cannot deadlock), merge the
+        keys into what the shards hold on disk, and replace each shard atomically; nothing is written if
+        any shard is not serializable'''
+        with self._mutex, ExitStack() as locks:
+            os.makedirs(self._filename, exist_ok=True)
+            shards = {}
+            for k in self._dirty:
+                shards.setdefault(self._shard(k), []).append(k)
+
+            texts = {}
+            for name in sorted(shards):
+                locks.enter_context(FileLock(join(self._filename, '.filelock.'+name)))
+                content = self._read_shard(name)
+                for k in shards[name]:
+                    if k in self._content:
+                        content[k] = self._content[k]
+                    else:
+                        content.pop(k, None)
+                texts[name] = self._codec.dumps(content) if content else None
+
+            for name, text in texts.items():
+                path = join(self._filename, name)
+                if text is None:
+                    if exists(path):
+                        os.remove(path)
+                    continue
+                tmp = join(self._filename, '.tmp.'+name)
+                with open(tmp, 'w') as f:
+                    f.write(text)
+                    if self._fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp, path)
+            self._dirty.clear()
+
+
+class SqliteYamster(Yamster):
+    '''Yamster stored in an SQLite database in WAL mode, one row per key
+    Yamster() returns one for .sqlite, .sqlite3 and .db files. Values are encoded by the codec (YAML
+    unless given). Readers never block writers, and a save is a single transaction of row upserts that
+    also bumps a version counter; each row records the version that last wrote it (deleted keys stay as
+    NULL rows), so that a reactive store only fetches the rows written since the version it has seen.
+    '''
+    _extensions = ('.sqlite', '.sqlite3', '.db')
+    _timeout = 30 # seconds to wait for another writer's transaction
+
+    def __init__(self, filename: str, callback: Callable[[str, Any, Any], NoReturn]=None,
+            write_behind: float=None, fsync: bool=False, codec: Codec=None, journal: bool=False,
+            lazy: bool=False):
+        '''Arguments as for Yamster, except that journal and lazy do not apply (SQLite has its own log)'''
+        if '_callbacks' not in vars(self):
+            self._db = None
+            self._version = 0 # of the content in memory
+        super().__init__(filename, callback, write_behind, fsync, codec)
+        self._lock = self._mutex # SQLite does the inter-process locking
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            db = sqlite3.connect(self._filename, timeout=self._timeout, isolation_level=None,
+                check_same_thread=False) # used by the monitor thread too, under _mutex
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute(f'PRAGMA synchronous={"FULL" if self._fsync else "NORMAL"}')
+            db.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT, version INTEGER)')
+            db.execute('CREATE INDEX IF NOT EXISTS store_version ON store (version)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+            db.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+            self._db = db
+        return self._db
+
+    def _decode(self, text: str) -> Any:
+        return self._codec.load(io.StringIO(text))
+
+    def _fetch(self, since: int) -> Dict[str, Any]:
+        'rows written after version since, None for deleted keys; updates _version'
+        db = self._connection()
+        db.execute('BEGIN') # one snapshot for the counter and the rows
+        try:
+            version = db.execute("SELECT value FROM meta WHERE name='version'").fetchone()[0]
+            rows = {} if version == since else {k: None if v is None else self._decode(v)
+                for k, v in db.execute('SELECT key, value FROM store WHERE version > ?', (since,))}
+        finally:
+            db.execute('COMMIT')
+        self._version = version
+        return rows
+
+    def _fingerprint(self):
+        return None # the version counter
+
+    def _watches(self) -> list:
+        d, f = split(self._filename)
+        return [(d, f, FILE_MASK), (d, f+'-wal', FILE_MASK)] # -wal for writers other than SqliteYamster
+
+    def _load(self):
+        with self._mutex:
+            self._content = {k: v for k, v in self._fetch(0).items() if v is not None}
+            self._size = os.path.getsize(self._filename)
+
+    def _react(self) -> bool:
+        if self._pending:
+            return False # our own write-behind flush is about to write
+        with self._mutex:
+            old_content = self._content
+            rows = self._fetch(self._version)
+            if rows:
+                content = dict(old_content)
+                for k, v in rows.items():
+                    if v is None:
+                        content.pop(k, None)
+                    else:
+                        content[k] = v
+                self._content = content
+        return self._notify(old_content, self._content, rows)
+
+    def _save(self):
+        'upsert the dirty keys in one transaction; nothing is written if a value is not serializable'
+        with self._mutex:
+            rows = [(k, self._codec.dumps(self._content[k]) if k in self._content else None) for k in self._dirty]
+            db = self._connection()
+            if not rows:
+                return
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                version = db.execute("SELECT value FROM meta WHERE name='version'").fetchone()[0] + 1
+                db.execute("UPDATE meta SET value=? WHERE name='version'", (version,))
+                db.executemany('INSERT OR REPLACE INTO store VALUES (?, ?, ?)', [(k, v, version) for k, v in rows])
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+            # the -wal file is written before the commit is visible to readers: signal it once it is
+            os.utime(self._filename)
+            if version == self._version + 1:
+                self._version = version # else other writers' rows are still to be fetched
+            self._dirty.clear()
+
+
+class _ReactMonitor(Poller):
+    '''Watches a reactive Yamster
+    All reactive stores share the monitor module's single watcher thread, which is driven by inotify
+    where available.
+    '''
+    max_interval = 0.5 # polling latency ceiling when inotify is not available
+
+    def __init__(self, store: Yamster):
+        self.store = store
+        super().__init__()
+
+    def watches(self):
+        return self.store._watches()
+
+    def poll(self):
+        return self.store._react()
 
 
 class TestYamster(unittest.TestCase):
@@ -158,12 +1151,342 @@ class TestYamster(unittest.TestCase):
             self.assertEqual(z.x, 7)
             z.x = 12
 
+            # keys named like methods are only reachable as items
+            with self.assertRaises(AttributeError):
+                z.update = 5
+            z['update'] = 5
+            self.assertEqual(z['update'], 5)
+            del z['update']
+            self.assertEqual(z['update'], None)
+
             with open(filename) as f:
                 s = f.read()
                 print (s)
 
             time.sleep(.5)
 
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'batch.yaml')
+            y = Yamster(filename)
+            saves = []
+            y._save = lambda: saves.append(dict(y._content))
+
+            with y.batch():
+                for i in range(50):
+                    y[f'k{i}'] = i
+            self.assertEqual(len(saves), 1)
+
+            y.update({'k0': None, 'k1': 'one'})
+            self.assertEqual(len(saves), 2)
+            self.assertEqual((y.k0, y.k1), (None, 'one'))
+
+            object.__delattr__(y, '_save')
+            with self.assertRaises(TypeError):
+                with y.batch():
+                    y.k2 = 'two'
+                    y.bad = y
+            self.assertEqual((y.k2, y.bad), (2, None))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'cache.yaml')
+            y = Yamster(filename)
+            y.a = 1
+            loads = []
+            y._load = lambda: loads.append(1)
+            self.assertIs(Yamster(join(dirname, '..', basename(dirname), 'cache.yaml')), y)
+            self.assertEqual(loads, [])
+
+            ref = weakref.ref(y)
+            del y
+            try:
+                Yamster._cache_size = 1
+                Yamster(join(dirname, 'other.yaml'))
+            finally:
+                Yamster._cache_size = 64
+            self.assertIsNone(ref())
+
+    def test_lazy(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'lazy.yaml')
+            doc = {'a': [1, {'b': 'multi\nline'}], 'c': {'d': [1, 2]}, 'e': 'x: 1'}
+            with open(filename, 'w') as f:
+                f.write('# settings\n' + yaml.safe_dump(doc))
+
+            y = Yamster(filename, lazy=True)
+            self.assertNotIn('_content', vars(y))
+            self.assertEqual((y.c, y.e, y.missing), (doc['c'], doc['e'], None))
+            self.assertEqual(sorted(y._index), ['a', 'c', 'e'])
+            self.assertNotIn('_content', vars(y))
+
+            c = y.c
+            y.f = 1 # parses everything
+            self.assertIs(y._content['c'], c)
+            with open(filename) as f:
+                self.assertEqual(yaml.safe_load(f), dict(doc, f=1))
+
+            with open(filename, 'w') as f:
+                f.write('a: &x [1]\nb: *x\nyes: 2\n')
+            Yamster.cache_clear()
+            y = Yamster(filename, lazy=True)
+            self.assertEqual(y.b, [1]) # alias to another entry: parsed whole
+            self.assertIn('_content', vars(y))
+
+    def test_sharded(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            path = join(dirname, 'store.d')
+            y = Yamster(path)
+            self.assertIsInstance(y, ShardedYamster)
+            y.update({'a': 1, 'b/c': [2], '.hidden': 3})
+            self.assertEqual(sorted(os.listdir(path)), ['%2Ehidden.yaml', '.filelock.%2Ehidden.yaml',
+                '.filelock.a.yaml', '.filelock.b%2Fc.yaml', 'a.yaml', 'b%2Fc.yaml'])
+            with self.assertRaises(TypeError):
+                with y.batch():
+                    y.a = 2
+                    y.bad = y
+            self.assertEqual(y.a, 1)
+
+            events = []
+            z = ShardedYamster(join(dirname, 'buckets'), lambda *e: events.append(e), buckets=4)
+            Yamster.cache_clear()
+            w = ShardedYamster(join(dirname, 'buckets'), buckets=4) # another writer
+            self.assertIsNot(w, z)
+            w.update({f'k{i}': i for i in range(20)})
+            z.k0 = 'zero' # merged into its shard, not overwriting the other keys
+            for _ in range(100):
+                if z.k1 == 1:
+                    break
+                time.sleep(0.02)
+            w.k1 = None
+            for _ in range(100):
+                if ('k1', 1, None) in events:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(len(os.listdir(join(dirname, 'buckets'))), 8)
+            self.assertIn(('k1', 1, None), events)
+            self.assertEqual((z.k0, z.k19, z.k1), ('zero', 19, None))
+            w._load()
+            self.assertEqual((w.k0, w.k19), ('zero', 19))
+            z.close()
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'store.db')
+            events = []
+            y = Yamster(filename, lambda *e: events.append(e))
+            self.assertIsInstance(y, SqliteYamster)
+            y.update({f'k{i}': {'i': i} for i in range(100)})
+            with self.assertRaises(TypeError):
+                y.bad = y
+
+            Yamster.cache_clear()
+            z = Yamster(filename)
+            self.assertIsNot(z, y)
+            self.assertEqual(z.k99, {'i': 99})
+            reader = sqlite3.connect(filename)
+            reader.execute('BEGIN')
+            reader.execute('SELECT * FROM store').fetchall() # an open read transaction does not block writers
+            z.k1 = None
+            z.k2 = 'two'
+            reader.execute('COMMIT')
+            for _ in range(100):
+                if len(events) == 2:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(events, [('k1', {'i': 1}, None), ('k2', {'i': 2}, 'two')])
+            self.assertEqual((y._version, z._version), (3, 3))
+            y.close()
+
+    def test_locks(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'locks.yaml')
+            y = Yamster(filename)
+            n = y._lock.acquires
+            y.a = 1
+            y._load()
+            self.assertEqual(y._lock.acquires, n + 1) # one per write, none per snapshot read
+
+            other = RWFileLock(y._lock_filename) # as another process would
+            with other.shared(), y._lock.shared():
+                self.assertEqual(y._lock.contended, 0)
+
+            held = threading.Event()
+            def hold():
+                with other:
+                    held.set()
+                    time.sleep(0.2)
+            threading.Thread(target=hold).start()
+            held.wait()
+            y.a = 2
+            self.assertEqual(y._lock.contended, 1)
+            self.assertGreater(y._lock.wait, 0.1)
+
+            fds = len(os.listdir('/proc/self/fd')) if exists('/proc/self/fd') else None
+            with y._lock.shared(), y._lock: # upgrade
+                pass
+            for i in range(20):
+                Yamster(join(dirname, f'{i}.yaml')).a = i
+            if fds is not None:
+                self.assertEqual(len(os.listdir('/proc/self/fd')), fds) # the lock files are closed
+
+    def test_shm(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'shm.yaml')
+            y = Yamster(filename, shm=True)
+            try:
+                y.a = [1, 2]
+                Yamster.cache_clear()
+                events = []
+                z = Yamster(filename, shm=True) # as another process would
+                z._callbacks.append(lambda *e: events.append(e))
+                z._read = None # never parses the file
+                self.assertEqual(z.a, [1, 2])
+
+                y.a = 3
+                self.assertEqual((z.a, events), (3, [('a', [1, 2], 3)]))
+
+                y.big = 'x' * y._shm.size
+                object.__delattr__(z, '_read')
+                self.assertEqual(len(z.big), y._shm.size) # does not fit: read from the file
+            finally:
+                y.unlink_shm()
+
+    def test_cache_callback(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'cb.yaml')
+            y = Yamster(filename)
+            y.x = 1
+            y._load()
+            with open(filename, 'w') as f:
+                f.write('x: 2\n') # while nothing is watching
+            events = []
+            self.assertIs(Yamster(filename, lambda *e: events.append(e)), y)
+            for _ in range(100):
+                if events:
+                    break
+                time.sleep(0.02)
+            self.assertEqual((y.x, events), (2, [('x', 1, 2)]))
+            y.close()
+
+    def test_local_changes(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'local.yaml')
+            y = Yamster(filename)
+            y.a = 1
+            self.assertEqual(y._t, y._fingerprint()) # our own write is not reloaded
+
+            def external(text):
+                with open(filename, 'w') as f:
+                    f.write(text)
+                y._react() # as the monitor would, right now
+
+            with y.batch():
+                y.b = 2
+                external('a: 1\nc: 3\n')
+            # between _set and _save taking the lock
+            y._set('d', 4)
+            external('a: 1\nb: 2\nc: 3\ne: 5\n')
+            y._save()
+            with open(filename) as f:
+                self.assertEqual(yaml.safe_load(f), {'a': 1, 'b': 2, 'c': 3, 'd': 4, 'e': 5})
+
+    def test_diff(self):
+        old = {'geom': [0, 0, 640, 480], 'view': {'zoom': 1, 'pan': [0, 0]}, 'x': 1}
+        new = {'geom': [0, 0, 800, 480], 'view': {'zoom': 1, 'pan': [5, 0]}, 'y': 2}
+        self.assertEqual(sorted(diff(old, new), key=str), [
+            (('geom', 2), 640, 800), (('view', 'pan', 0), 0, 5), (('x',), 1, None), (('y',), None, 2)])
+
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'sub.yaml')
+            y = Yamster(filename)
+            y.update(old)
+            events = []
+            y.subscribe(lambda *e: events.append(e), ('view',))
+            with open(filename, 'w') as f:
+                yaml.safe_dump(new, f)
+            for _ in range(100):
+                if events:
+                    break
+                time.sleep(0.02)
+            self.assertEqual(events, [(('view', 'pan', 0), 0, 5)])
+            y.close()
+
+    def test_codecs(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'store.json')
+            y = Yamster(filename)
+            y.a = [1, 2]
+            with self.assertRaises(TypeError):
+                y.bad = y
+            with open(filename) as f:
+                self.assertEqual(json.load(f), {'a': [1, 2]})
+
+    def test_journal(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'journal.yaml')
+            y = Yamster(filename, journal=True)
+            y.keep = 'me'
+            y.update({'a': 1, 'b': {'multi': 'line\ntext'}})
+            y.a = None
+            self.assertTrue(exists(join(dirname, '.journal.journal.yaml')))
+
+            Yamster.cache_clear()
+            z = Yamster(filename)
+            self.assertEqual((z.keep, z.a, z.b), ('me', None, {'multi': 'line\ntext'}))
+            self.assertEqual(z._log_records, 4)
+
+            with open(join(dirname, '.journal.journal.yaml'), 'a') as f:
+                f.write('---\n- a\n- 5\n- ') # torn record
+            z._load()
+            self.assertEqual(z.a, None)
+
+            y._journal_max_records = 10
+            y.c = -1 # compacts because of the torn record
+            self.assertFalse(exists(join(dirname, '.journal.journal.yaml')))
+            y.c = 0
+            self.assertTrue(exists(join(dirname, '.journal.journal.yaml')))
+            for i in range(10):
+                y.c = i
+            self.assertFalse(exists(join(dirname, '.journal.journal.yaml')))
+            z._load()
+            self.assertEqual(z.c, 9)
+
+            z.d = 'from z' # appended behind the back of y
+            y.e = 0
+            for i in range(10):
+                y.e = i # compacts
+            self.assertFalse(exists(join(dirname, '.journal.journal.yaml')))
+            self.assertEqual((y.d, y.e), ('from z', 9))
+            z._load()
+            self.assertEqual((z.d, z.e), ('from z', 9))
+
+    def test_write_behind(self):
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = join(dirname, 'wb.yaml')
+            y = Yamster(filename, write_behind=0.2)
+            for i in range(100):
+                y.geom = (i, i, 100, 100)
+            self.assertGreater(y.pending(), 0) # not flushed again before write_behind seconds
+            with self.assertRaises(TypeError):
+                y.bad = y
+
+            time.sleep(0.5)
+            self.assertEqual(y.pending(), 0)
+            with open(filename) as f:
+                self.assertEqual(yaml.safe_load(f)['geom'], [99, 99, 100, 100])
+
+            y.x = 1
+            y.close()
+            with open(filename) as f:
+                self.assertEqual(yaml.safe_load(f)['x'], 1)
+
+            # the exit flush does not keep stores alive
+            ref = weakref.ref(Yamster(join(dirname, 'wb2.yaml'), write_behind=0.2))
+            Yamster.cache_clear()
+            gc.collect()
+            self.assertIsNone(ref())
+
 if __name__ == '__main__':
     unittest.main()
 
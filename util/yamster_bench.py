@@ -0,0 +1,197 @@
+r'''Benchmark yamster.Yamster stores
+
+Runs without a GUI on tmpfs (/dev/shm when available) and prints JSON results, for each storage
+backend and document size:
+
+- setup_s, open_s: time to write the document in one batch, and to open it in a fresh store
+- rss_kb: resident memory added by opening it
+- reload_ms: reload (_load) latency percentiles
+- set_ms: single-key write latency percentiles, in one process
+- lock_wait_s, lock_contended: time and acquisitions spent waiting for the store lock (null for the
+  sharded and sqlite backends, whose locks are not instrumented)
+- multi: writers in other processes, each setting its own key at --rate writes per second: their
+  set_ms and lock wait, and the delay until the reactive callback of this process sees their writes
+  (propagation_ms), with the number of writes seen (coalesced writes are only seen once)
+
+Examples:
+  yamster_bench --keys 10,1000,10000
+  yamster_bench --keys 100000 --backends sqlite,sharded --procs 4 -o big.json
+'''
+
+import os, sys
+import json
+import random
+import shutil
+import tempfile
+import time
+import multiprocessing
+from argparse import ArgumentParser, RawTextHelpFormatter
+from os.path import join, basename, splitext, exists
+
+from monitor_bench import rss_kb, percentiles
+from yamster import Yamster
+
+this_name = splitext(basename(__file__))[0]
+
+# backend -> file name, Yamster options
+BACKENDS = {
+    'file': ('store.yaml', {}),
+    'json': ('store.json', {}),
+    'journal': ('store.yaml', {'journal': True}),
+    'shm': ('store.yaml', {'shm': True}),
+    'sharded': ('store.d', {'buckets': 64}),
+    'sqlite': ('store.db', {}),
+}
+
+
+def value(i: int) -> dict:
+    'a view record, as gview stores them'
+    return {'geom': [i, i, 640, 480], 'visible': True, 'name': f'image{i}.png'}
+
+
+def lock_stats(y: Yamster) -> dict:
+    lock = y._lock
+    if not hasattr(lock, 'contended'):
+        return {'lock_wait_s': None, 'lock_contended': None} # not measured
+    return {'lock_wait_s': round(lock.wait, 6), 'lock_contended': lock.contended}
+
+
+def total(values: list):
+    'sum of measurements, None if they were not measured'
+    return None if None in values else round(sum(values), 6)
+
+
+def writer(path: str, options: dict, wid: int, writes: int, rate: float) -> dict:
+    'another process setting its own key to the time of the write'
+    y = Yamster(path, **options)
+    latencies = []
+    for i in range(writes):
+        t = time.monotonic()
+        y[f'probe{wid}'] = t
+        latencies.append(time.monotonic() - t)
+        if rate:
+            time.sleep(1 / rate)
+    y.close()
+    return dict(set_ms=latencies, **lock_stats(y))
+
+
+def bench_multi(path: str, options: dict, y: Yamster, procs: int, writes: int, rate: float) -> dict:
+    delays = []
+    def on_change(k, old, new):
+        if k.startswith('probe') and new:
+            delays.append(time.monotonic() - new) # CLOCK_MONOTONIC is system wide
+    Yamster(path, on_change) # y, now reactive
+
+    with multiprocessing.get_context('spawn').Pool(procs) as pool:
+        results = pool.starmap(writer, [(path, options, wid, writes, rate) for wid in range(procs)])
+    time.sleep(1.0) # last callbacks
+    y.close()
+
+    return {
+        'procs': procs,
+        'writes': procs * writes,
+        'rate': rate,
+        'set_ms': percentiles([t for r in results for t in r['set_ms']]),
+        'lock_wait_s': total([r['lock_wait_s'] for r in results]),
+        'lock_contended': total([r['lock_contended'] for r in results]),
+        'propagation_ms': percentiles(delays),
+        'seen': len(delays),
+    }
+
+
+def bench_store(dirname: str, backend: str, n: int, writes: int, reloads: int, procs: int, rate: float) -> dict:
+    filename, options = BACKENDS[backend]
+    path = join(dirname, f'{backend}{n}', filename)
+    os.makedirs(os.path.dirname(path))
+
+    t0 = time.monotonic()
+    y = Yamster(path, **options)
+    y.update({f'k{i}': value(i) for i in range(n)})
+    setup = time.monotonic() - t0
+    y.close()
+    del y
+    Yamster.cache_clear()
+
+    rss0 = rss_kb()
+    t0 = time.monotonic()
+    y = Yamster(path, **options)
+    y.k0 # lazy modes load on access
+    open_s = time.monotonic() - t0
+    rss = rss_kb() - rss0
+
+    latencies = []
+    for _ in range(reloads):
+        t0 = time.monotonic()
+        y._load()
+        latencies.append(time.monotonic() - t0)
+    reload = percentiles(latencies)
+
+    latencies = []
+    for i in range(writes):
+        k = f'k{random.randrange(n)}'
+        t0 = time.monotonic()
+        y[k] = value(i)
+        latencies.append(time.monotonic() - t0)
+
+    result = {
+        'backend': backend,
+        'keys': n,
+        'bytes': y._size,
+        'setup_s': round(setup, 3),
+        'open_s': round(open_s, 6),
+        'rss_kb': rss,
+        'reload_ms': reload,
+        'set_ms': percentiles(latencies),
+        **lock_stats(y),
+    }
+    if procs:
+        result['multi'] = bench_multi(path, options, y, procs, writes, rate)
+    if options.get('shm'):
+        y.unlink_shm()
+    y.close()
+    Yamster.cache_clear()
+    return result
+
+
+def yamster_bench(keys: list, backends: list, writes: int, reloads: int, procs: int, rate: float, tmp: str) -> dict:
+    dirname = tempfile.mkdtemp(prefix=this_name, dir=tmp)
+    try:
+        return {
+            'python': sys.version.split()[0],
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'tmp': tmp,
+            'results': [bench_store(dirname, b, n, writes, reloads, procs, rate) for n in keys for b in backends],
+        }
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+
+def main():
+    parser = ArgumentParser(prog=this_name, formatter_class=RawTextHelpFormatter, description=__doc__)
+    parser.add_argument('--keys', default='10,1000,10000', help='comma separated document sizes (default 10,1000,10000)')
+    parser.add_argument('--backends', default='file,journal,shm,sharded,sqlite',
+        help=f'comma separated, among {",".join(BACKENDS)}')
+    parser.add_argument('--writes', type=int, default=50, help='writes per process')
+    parser.add_argument('--reloads', type=int, default=5, help='reloads for the reload latency')
+    parser.add_argument('--procs', type=int, default=2, help='writer processes (0: single process only)')
+    parser.add_argument('--rate', type=float, default=50, help='writes per second of each writer process (0: unthrottled)')
+    parser.add_argument('--tmp', default='/dev/shm' if exists('/dev/shm') else None, help='scratch directory (default tmpfs)')
+    parser.add_argument('-o', help='write JSON here instead of stdout')
+
+    args = parser.parse_args()
+    backends = args.backends.split(',')
+    for b in backends:
+        if b not in BACKENDS:
+            parser.error(f'unknown backend {b}')
+    keys = [int(n) for n in args.keys.split(',')]
+    result = yamster_bench(keys, backends, args.writes, args.reloads, args.procs, args.rate, args.tmp)
+
+    if args.o:
+        with open(args.o, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+if __name__=='__main__':
+    main()